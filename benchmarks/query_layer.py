@@ -0,0 +1,187 @@
+"""Latency of the CalibreDBW query paths on generated libraries.
+
+    python -m benchmarks.query_layer [--sizes 1000,10000,100000,500000]
+        [--calls 50] [--warm] [--library-dir DIR] [--output results.json]
+
+Each case is run --calls times and reported as p50/p95/p99 latencies in
+milliseconds and rows returned per second, as JSON so runs of different
+versions can be compared. The library cache is cleared before every call
+unless --warm is given. Generated libraries are kept in --library-dir when
+set, and reused by later runs.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_library import generate_library
+from calibre_wrapper.calibredb import CalibreDBW
+
+PAGE_SIZE = 21
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(fn, calls, warm, calibredb):
+    """fn() returns the number of rows it fetched."""
+    fn()
+    timings, rows = [], 0
+    for _ in range(calls):
+        if not warm:
+            calibredb._cache.clear()
+        start = time.perf_counter()
+        rows += fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'calls': calls,
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'rows_per_s': round(rows / sum(timings), 1) if sum(timings) else None,
+    }
+
+
+def cases(calibredb, book_count):
+    def search(search, attribute=None, **kwargs):
+        return lambda: len(calibredb.search_books(search, attribute,
+            limit=PAGE_SIZE, **kwargs))
+
+    deep_page = max(1, book_count // PAGE_SIZE // 2)
+    # the token of the same deep page, for the keyset walk
+    deep_after = calibredb.search_books_page(None, None, page=deep_page - 1,
+            limit=PAGE_SIZE)[1] if deep_page > 1 else None
+    book_ids = [book['id'] for book in calibredb.search_books(None, None,
+        page=2, limit=PAGE_SIZE)]
+
+    def get_book():
+        return int(calibredb.get_book(book_ids[0]) is not None)
+
+    def get_books():
+        return len(calibredb.get_books(book_ids))
+
+    def get_book_details():
+        return int(bool(calibredb.get_book_details(book_ids[1])[0]))
+
+    def list_attributes(list_fn, **kwargs):
+        return lambda: len(list_fn(limit=100, **kwargs))
+
+    return [
+        ('search_books: latest', search(None)),
+        ('search_books: full-text, accent-insensitive', search('chateau')),
+        ('search_books: author, accent-insensitive', search('emile', 'authors')),
+        ('search_books: series', search('slow horses', 'series')),
+        ('search_books: tags include', search('fiction', 'tags')),
+        ('search_books: tags include/exclude', search('fiction, fantasy, -read', 'tags')),
+        ('search_books: read_status unread', search(None, read_status='unread')),
+        ('search_books: format filter', search(None, book_format='EPUB,MOBI')),
+        ('search_books: deep page (offset)', lambda: len(calibredb.search_books(
+            None, None, page=deep_page, limit=PAGE_SIZE))),
+        ('search_books: deep page (after)', lambda: len(calibredb.search_books_page(
+            None, None, limit=PAGE_SIZE, after=deep_after)[0])),
+        ('search_facets: full-text', lambda: sum(len(values) for values
+            in calibredb.search_facets('chateau', None).values())),
+        ('list_authors: first page', list_attributes(calibredb.list_authors, page=1)),
+        ('list_authors: deep page', list_attributes(calibredb.list_authors,
+            page=max(1, book_count // 4 // 100 // 2))),
+        ('list_authors: prefix', list_attributes(calibredb.list_authors, page=1,
+            prefix='Zo')),
+        ('list_tags: first page', list_attributes(calibredb.list_tags, page=1)),
+        ('list_series: first page', list_attributes(calibredb.list_series, page=1)),
+        ('count_authors', lambda: int(calibredb.count_authors() >= 0)),
+        ('get_book', get_book),
+        ('get_books: one page', get_books),
+        ('get_book_details', get_book_details),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, check=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_size(library, book_count, args):
+    metadata_db = os.path.join(library, 'metadata.db')
+    results = []
+    if not os.path.exists(metadata_db):
+        start = time.perf_counter()
+        # written aside so an interrupted run leaves nothing to reuse
+        generate_library(metadata_db + '.tmp', book_count, args.seed)
+        os.replace(metadata_db + '.tmp', metadata_db)
+        print('generated %d books in %.1fs' % (book_count, time.perf_counter() - start),
+                file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    calibredb = CalibreDBW({'CALIBRE_LIBRARY_PATH': library,
+        'CALIBRE_WEBUI_DB_PATH': library, 'CALIBRE_TEMP_DIR': library})
+    calibredb.refresh_search_index()
+    results.append({'books': book_count, 'case': 'open library and sync search index',
+        'seconds': round(time.perf_counter() - start, 3)})
+
+    for name, fn in cases(calibredb, book_count):
+        result = {'books': book_count, 'case': name}
+        result.update(measure(fn, args.calls, args.warm, calibredb))
+        results.append(result)
+        print('%8d  %-48s p50 %9.3fms  p95 %9.3fms  p99 %9.3fms' % (book_count, name,
+            result['p50_ms'], result['p95_ms'], result['p99_ms']),
+            file=sys.stderr, flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,500000',
+            help='comma separated library sizes, in books')
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--warm', action='store_true',
+            help='keep the library cache between calls')
+    parser.add_argument('--library-dir',
+            help='where to keep the generated libraries, a temporary directory otherwise')
+    parser.add_argument('--output', help='JSON output file, stdout otherwise')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'sqlalchemy': sqlalchemy.__version__,
+        'calls': args.calls,
+        'warm': args.warm,
+        'seed': args.seed,
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for book_count in [int(size) for size in args.sizes.split(',')]:
+            library = os.path.join(args.library_dir or tmp_dir,
+                    'library-%d-%d' % (book_count, args.seed))
+            os.makedirs(library, exist_ok=True)
+            # keep stdout for the report
+            with contextlib.redirect_stdout(sys.stderr):
+                report['results'] += run_size(library, book_count, args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
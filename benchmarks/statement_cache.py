@@ -0,0 +1,84 @@
+"""Per-call cost of the CalibreDBW queries with their statements rebuilt on
+every call, as they used to be, against the cached statements.
+
+    python -m benchmarks.statement_cache [--books 2000] [--calls 500]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_library import generate_library
+from calibre_wrapper.calibredb import CalibreDBW
+
+
+def per_call(fn, calls):
+    fn()
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as library:
+        generate_library(os.path.join(library, 'metadata.db'), args.books)
+        calibredb = CalibreDBW({'CALIBRE_LIBRARY_PATH': library,
+            'CALIBRE_WEBUI_DB_PATH': library, 'CALIBRE_TEMP_DIR': library})
+        calibredb.refresh_search_index()
+        book_ids = [row.id for row in calibredb._execute(('bench_ids',),
+            lambda: select(calibredb._tables['books'].c.id).limit(21))]
+
+        def uncached(build, params):
+            def run():
+                with calibredb._db_ng.connect() as con:
+                    con.execute(build(), params).all()
+            return run
+
+        def cached(key, build, params):
+            return lambda: calibredb._execute(key, build, **params)
+
+        search_shape = (None, 'like', False, False, True, 'unread', False)
+        fts_shape = (None, 'fts', False, False, False, None, False)
+        tags_shape = ('tags', 'tags', True, True, False, None, False)
+        tag_ids = calibredb._get_tag_ids(['fiction', 'read'])
+        cases = [
+            ('get_book', ('load_books',), calibredb._build_load_books_query,
+                {'book_ids': book_ids[:1]}),
+            ('get_books (page)', ('load_books',), calibredb._build_load_books_query,
+                {'book_ids': book_ids}),
+            ('search (like, format, unread)', ('search',) + search_shape,
+                lambda: calibredb._build_search_query(*search_shape),
+                {'pattern': '%chateau%', 'formats': ['EPUB'],
+                    'read_tag': tag_ids[1:], 'limit': 22, 'offset': 0}),
+            ('search (full-text)', ('search',) + fts_shape,
+                lambda: calibredb._build_search_query(*fts_shape),
+                {'fts_query': '"chateau"*', 'limit': 22, 'offset': 0}),
+            ('search (tags)', ('search',) + tags_shape,
+                lambda: calibredb._build_search_query(*tags_shape),
+                {'include_tags': tag_ids[:1], 'exclude_tags': tag_ids[1:],
+                    'limit': 22, 'offset': 0}),
+            ('list_tags (link tables)', ('attributes', 'tags', False, False, False),
+                lambda: calibredb._build_attributes_query('tags', 'tag', False), {}),
+            ('list_tags (facet counts)', ('facet_counts', False, False, False),
+                lambda: calibredb._build_facet_counts_query(False), {'facet': 'tags'}),
+        ]
+
+        print('%-32s %12s %12s %12s' % ('query (us/call)', 'rebuilt', 'cached', 'saved'))
+        for name, key, build, params in cases:
+            before = per_call(uncached(build, params), args.calls)
+            after = per_call(cached(key, build, params), args.calls)
+            print('%-32s %12.0f %12.0f %11.0f%%'
+                    % (name, before, after, 100 * (before - after) / before))
+
+
+if __name__ == '__main__':
+    main()
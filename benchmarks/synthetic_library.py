@@ -0,0 +1,183 @@
+"""Builds a calibre-schema metadata.db filled with made up books, so the query
+layer can be measured without calibre installed."""
+import itertools
+import os
+import random
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL DEFAULT 'Unknown' COLLATE NOCASE, sort TEXT COLLATE NOCASE,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, pubdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    series_index REAL NOT NULL DEFAULT 1.0, author_sort TEXT COLLATE NOCASE,
+    isbn TEXT DEFAULT "" COLLATE NOCASE, lccn TEXT DEFAULT "" COLLATE NOCASE,
+    path TEXT NOT NULL DEFAULT "", flags INTEGER NOT NULL DEFAULT 1, uuid TEXT,
+    has_cover BOOL DEFAULT 0,
+    last_modified TIMESTAMP NOT NULL DEFAULT "2000-01-01 00:00:00+00:00");
+CREATE INDEX books_idx ON books (sort COLLATE NOCASE);
+CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT NOT NULL COLLATE NOCASE,
+    sort TEXT COLLATE NOCASE, link TEXT NOT NULL DEFAULT "", UNIQUE(name));
+CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    author INTEGER NOT NULL, UNIQUE(book, author));
+CREATE INDEX books_authors_link_aidx ON books_authors_link (author);
+CREATE INDEX books_authors_link_bidx ON books_authors_link (book);
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL COLLATE NOCASE,
+    link TEXT NOT NULL DEFAULT "", UNIQUE (name));
+CREATE TABLE books_tags_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    tag INTEGER NOT NULL, UNIQUE(book, tag));
+CREATE INDEX books_tags_link_aidx ON books_tags_link (tag);
+CREATE INDEX books_tags_link_bidx ON books_tags_link (book);
+CREATE TABLE series (id INTEGER PRIMARY KEY, name TEXT NOT NULL COLLATE NOCASE,
+    sort TEXT COLLATE NOCASE, link TEXT NOT NULL DEFAULT "", UNIQUE (name));
+CREATE TABLE books_series_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    series INTEGER NOT NULL, UNIQUE(book));
+CREATE INDEX books_series_link_aidx ON books_series_link (series);
+CREATE INDEX books_series_link_bidx ON books_series_link (book);
+CREATE TABLE publishers (id INTEGER PRIMARY KEY, name TEXT NOT NULL COLLATE NOCASE,
+    sort TEXT COLLATE NOCASE, link TEXT NOT NULL DEFAULT "", UNIQUE(name));
+CREATE TABLE books_publishers_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    publisher INTEGER NOT NULL, UNIQUE(book));
+CREATE INDEX books_publishers_link_aidx ON books_publishers_link (publisher);
+CREATE INDEX books_publishers_link_bidx ON books_publishers_link (book);
+CREATE TABLE languages (id INTEGER PRIMARY KEY, lang_code TEXT NOT NULL COLLATE NOCASE,
+    link TEXT NOT NULL DEFAULT "", UNIQUE(lang_code));
+CREATE TABLE books_languages_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    lang_code INTEGER NOT NULL, item_order INTEGER NOT NULL DEFAULT 0,
+    UNIQUE(book, lang_code));
+CREATE INDEX books_languages_link_aidx ON books_languages_link (lang_code);
+CREATE INDEX books_languages_link_bidx ON books_languages_link (book);
+CREATE TABLE ratings (id INTEGER PRIMARY KEY, rating INTEGER CHECK(rating > -1 AND rating < 11),
+    link TEXT NOT NULL DEFAULT "", UNIQUE (rating));
+CREATE TABLE books_ratings_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    rating INTEGER NOT NULL, UNIQUE(book, rating));
+CREATE INDEX books_ratings_link_aidx ON books_ratings_link (rating);
+CREATE INDEX books_ratings_link_bidx ON books_ratings_link (book);
+CREATE TABLE comments (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    text TEXT NOT NULL COLLATE NOCASE, UNIQUE(book));
+CREATE INDEX comments_idx ON comments (book);
+CREATE TABLE identifiers (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    type TEXT NOT NULL DEFAULT "isbn" COLLATE NOCASE, val TEXT NOT NULL COLLATE NOCASE,
+    UNIQUE(book, type));
+CREATE TABLE data (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE, uncompressed_size INTEGER NOT NULL,
+    name TEXT NOT NULL, UNIQUE(book, format));
+CREATE INDEX data_idx ON data (book);
+CREATE INDEX formats_idx ON data (format);
+CREATE TABLE custom_columns (id INTEGER PRIMARY KEY AUTOINCREMENT, label TEXT NOT NULL,
+    name TEXT NOT NULL, datatype TEXT NOT NULL, mark_for_delete BOOL DEFAULT 0 NOT NULL,
+    editable BOOL DEFAULT 1 NOT NULL, display TEXT DEFAULT "{}" NOT NULL,
+    is_multiple BOOL DEFAULT 0 NOT NULL, normalized BOOL NOT NULL, UNIQUE(label));
+INSERT INTO custom_columns (label, name, datatype, normalized) VALUES ('pages', 'Pages', 'int', 0);
+CREATE TABLE custom_column_1 (id INTEGER PRIMARY KEY AUTOINCREMENT, book INTEGER,
+    value INTEGER NOT NULL, UNIQUE(book));
+CREATE TABLE metadata_dirtied (id INTEGER PRIMARY KEY, book INTEGER NOT NULL, UNIQUE(book));
+'''
+
+FIRST_NAMES = ['Émile', 'Victor', 'Gabriel', 'José', 'Anaïs', 'Stephen',
+        'Ursula', 'Zoë', 'Mick', 'Jane', 'Søren', 'Françoise', 'Chloé', 'Miguel']
+LAST_NAMES = ['Zola', 'Hugo', 'García Márquez', 'Saramago', 'Nin', 'King',
+        'Le Guin', 'Smith', 'Herron', 'Austen', 'Kierkegaard', 'Sagan', 'Brontë']
+TAGS = ['read', 'fiction', 'science fiction', 'fantasy', 'histoire', 'crime',
+        'classics', 'poésie', 'kids', 'essays', 'biographie', 'thriller']
+SERIES = ['Slow Horses', 'Les Rougon-Macquart', 'Earthsea', 'Dark Tower',
+        'Fondation', 'La Comédie humaine', 'Discworld']
+WORDS = ['misérables', 'horse', 'slow', 'night', 'château', 'wizard', 'tower',
+        'dark', 'sea', 'germinal', 'assommoir', 'love', 'cholera', 'été',
+        'garçon', 'forêt', 'river', 'winter', 'crown', 'mémoire']
+LANGUAGES = ['eng', 'fra', 'spa', 'por']
+PUBLISHERS = ['Gallimard', 'Penguin', 'Alfaguara', 'Tor', 'Folio']
+FORMATS = ['EPUB', 'MOBI', 'PDF', 'AZW3']
+
+
+def skewed_sampler(rnd, count):
+    """sample(k) picks k distinct ids in 1..count, the low ids much more
+    often: a few prolific authors and popular tags, and a long tail."""
+    cum_weights = list(itertools.accumulate((i + 1) ** -0.5 for i in range(count)))
+    ids = range(1, count + 1)
+    def sample(k):
+        picked = set()
+        while len(picked) < min(k, count):
+            picked.update(rnd.choices(ids, cum_weights=cum_weights, k=k - len(picked)))
+        return picked
+    return sample
+
+
+def generate_library(path, book_count, seed=1):
+    """Writes a library of book_count books to path, replacing any file there.
+
+    Every run with the same seed produces the same library."""
+    if os.path.exists(path):
+        os.remove(path)
+    rnd = random.Random(seed)
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+
+    # about four books per author and fifty per series on average, and a tag
+    # vocabulary growing with the library
+    authors = ['%s %s' % (first, last) for first in FIRST_NAMES for last in LAST_NAMES]
+    authors += ['%s %s %d' % (rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES), i)
+            for i in range(len(authors), book_count // 4)]
+    tags = TAGS + ['%s %d' % (rnd.choice(WORDS), i)
+            for i in range(len(TAGS), book_count // 200)]
+    series = SERIES + ['%s %d' % (rnd.choice(WORDS).title(), i)
+            for i in range(len(SERIES), book_count // 50)]
+    con.executemany('INSERT INTO authors (id, name, sort) VALUES (?, ?, ?)',
+            [(i + 1, name, name) for i, name in enumerate(authors)])
+    con.executemany('INSERT INTO tags (id, name) VALUES (?, ?)',
+            [(i + 1, name) for i, name in enumerate(tags)])
+    con.executemany('INSERT INTO series (id, name, sort) VALUES (?, ?, ?)',
+            [(i + 1, name, name) for i, name in enumerate(series)])
+    con.executemany('INSERT INTO languages (id, lang_code) VALUES (?, ?)',
+            [(i + 1, code) for i, code in enumerate(LANGUAGES)])
+    con.executemany('INSERT INTO publishers (id, name, sort) VALUES (?, ?, ?)',
+            [(i + 1, name, name) for i, name in enumerate(PUBLISHERS)])
+    con.executemany('INSERT INTO ratings (id, rating) VALUES (?, ?)',
+            [(i + 1, (i + 1) * 2) for i in range(5)])
+    sample_authors = skewed_sampler(rnd, len(authors))
+    # the 'read' tag comes first and is handed out on its own
+    sample_tags = skewed_sampler(rnd, len(tags) - 1)
+    sample_series = skewed_sampler(rnd, len(series))
+
+    books, links, data = [], {}, []
+    def link(table, *row):
+        links.setdefault(table, []).append(row)
+
+    for book in range(1, book_count + 1):
+        title = ' '.join(rnd.choice(WORDS)
+                for _ in range(rnd.randint(1, 4))).capitalize()
+        last_modified = '20%02d-%02d-%02d %02d:%02d:%02d+00:00' % (
+                rnd.randint(10, 25), rnd.randint(1, 12), rnd.randint(1, 28),
+                rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+        books.append((book, title, title, float(rnd.randint(1, 12)),
+                'Author/%s (%d)' % (title, book), rnd.random() < 0.8,
+                last_modified, 'uuid-%d' % book))
+        for author in sample_authors(rnd.choice([1, 1, 1, 2, 3])):
+            link('books_authors_link (book, author)', book, author)
+        for tag in sample_tags(rnd.randint(0, 4)):
+            link('books_tags_link (book, tag)', book, tag + 1)
+        if rnd.random() < 0.3:
+            link('books_tags_link (book, tag)', book, 1)
+        if rnd.random() < 0.3:
+            link('books_series_link (book, series)', book, sample_series(1).pop())
+        if rnd.random() < 0.6:
+            link('books_publishers_link (book, publisher)', book, rnd.randint(1, len(PUBLISHERS)))
+        if rnd.random() < 0.5:
+            link('books_ratings_link (book, rating)', book, rnd.randint(1, 5))
+        link('books_languages_link (book, lang_code)', book, rnd.randint(1, len(LANGUAGES)))
+        link('comments (book, text)', book, '<p>A tale of %s and %s.</p>'
+                % (rnd.choice(WORDS), rnd.choice(WORDS)))
+        link('identifiers (book, type, val)', book, 'isbn', '978%010d' % book)
+        if rnd.random() < 0.5:
+            link('custom_column_1 (book, value)', book, rnd.randint(20, 900))
+        for book_format in rnd.sample(FORMATS, rnd.choice([0, 1, 1, 1, 2, 3])):
+            data.append((book, book_format, rnd.randint(10000, 5000000), 'file%d' % book))
+
+    con.executemany('INSERT INTO books (id, title, sort, series_index, path, '
+            'has_cover, last_modified, uuid) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', books)
+    for table, rows in links.items():
+        con.executemany('INSERT INTO %s VALUES (%s)'
+                % (table, ', '.join('?' * len(rows[0]))), rows)
+    con.executemany('INSERT INTO data (book, format, uncompressed_size, name) '
+            'VALUES (?, ?, ?, ?)', data)
+    con.commit()
+    con.close()
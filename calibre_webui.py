@@ -1,4 +1,4 @@
-from calibre_webui import app
-
 if __name__ == '__main__':
+    # not when imported again by the children of a process pool
+    from calibre_webui import app
     app.run(debug=False)
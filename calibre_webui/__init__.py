@@ -4,6 +4,7 @@ from flask_qrcode import QRcode
 
 from calibre_webui.calibre_webui_db import CalibreWebUIDB
 from calibre_wrapper.calibredb import CalibreDBW
+from calibre_wrapper.disk_cache import DiskCache
 
 app = Flask(__name__)
 qrcode = QRcode(app)
@@ -29,5 +30,8 @@ app.FLASH = {'error': 'danger',
 
 app.calibredb_wrap = CalibreDBW(app.config)
 app.database = CalibreWebUIDB(app.config)
+app.retitle_cache = DiskCache(app.config.get('RETITLE_CACHE_DIR')
+            or os.path.join(app.config['CALIBRE_TEMP_DIR'], 'retitled'),
+        int(app.config.get('RETITLE_CACHE_SIZE', 1024 ** 3)))
 
 from calibre_webui import routes
@@ -27,8 +27,115 @@ RETITLE_DOWNLOADS = True
 RETITLE_FORMATS = ['MOBI', 'AZW', 'AZW3', 'PRC', 'EPUB', 'PDF', 'FB2', 'LRF',
         'HTMLZ', 'RTF']
 
+# Retitled copies are kept in RETITLE_CACHE_DIR (by default a retitled
+# directory under CALIBRE_TEMP_DIR) up to RETITLE_CACHE_SIZE bytes, the least
+# recently downloaded dropped first. 0 retitles a throwaway copy on each
+# download instead
+RETITLE_CACHE_DIR = ''
+RETITLE_CACHE_SIZE = 1024 ** 3
+
 # Directory to temporarily store uploaded or converted files
 CALIBRE_TEMP_DIR = '/data/tmp'
 
+# Book files, covers and thumbnails can be sent by the web server in front of
+# the app instead of a uWSGI worker: set FILE_OFFLOAD to 'nginx' for
+# X-Accel-Redirect, or 'sendfile' for X-Sendfile (Apache's mod_xsendfile,
+# lighttpd). nginx needs FILE_OFFLOAD_LOCATIONS, mapping the directories the
+# files are in (the library, and CALIBRE_TEMP_DIR for retitled copies and
+# thumbnails) to internal locations serving them, e.g.
+# {'/data/calibre_library': '/_library', '/data/tmp': '/_tmp'}
+FILE_OFFLOAD = ''
+FILE_OFFLOAD_LOCATIONS = {}
+
+# Cover thumbnails are made at each of these heights (in pixels, picked with
+# /thumb?size=), as WebP for the browsers asking for it and JPEG for the
+# others. They are kept in THUMBNAIL_CACHE_DIR (by default a thumbnails
+# directory under CALIBRE_TEMP_DIR), and made again when a cover changes
+THUMBNAIL_SIZES = {'feed': 200, 'grid': 400, 'detail': 800}
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CACHE_DIR = ''
+
+# Processes making the missing thumbnails in bulk, from the settings page or
+# `python -m calibre_webui.thumbnails`, one per CPU when 0. Uploaded books get
+# theirs as part of their import
+THUMBNAIL_WORKERS = 0
+
 # Path to store the internal calibre webui database
 CALIBRE_WEBUI_DB_PATH = '/data/calibre_library'
+
+# Number of library reads (book details, covers, search result pages...) each
+# worker keeps in memory. Entries are dropped whenever metadata.db changes
+LIBRARY_CACHE_SIZE = 2048
+
+# Tuning of the read-only SQLite connections to the Calibre library. Each
+# worker opens as many as its threads read at once, and keeps
+# LIBRARY_SQLITE_POOL_SIZE of them open between requests. The mmap size is in
+# bytes, and a negative cache size is in KiB, per connection. Size them after
+# metadata.db
+LIBRARY_SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+LIBRARY_SQLITE_CACHE_SIZE = -16384
+LIBRARY_SQLITE_BUSY_TIMEOUT = 5000
+LIBRARY_SQLITE_POOL_SIZE = 8
+
+# Library writes go through a calibredb process kept running between them
+# (started with calibre-debug), saving calibre's startup on each write. When
+# it cannot be started, each write runs its own calibredb as before. The
+# worker exits after CALIBREDB_WORKER_IDLE_TIMEOUT seconds without writes.
+# CALIBREDB_WORKER_COMMAND replaces the command starting it
+CALIBREDB_WORKER = True
+CALIBREDB_WORKER_IDLE_TIMEOUT = 300
+CALIBREDB_WORKER_COMMAND = ''
+
+# Extra ebook-convert options, per target format, e.g.
+# {'MOBI': ['--output-profile', 'kindle']}
+CONVERSION_OPTIONS = {}
+
+# Converted files are kept in CONVERSION_CACHE_DIR (by default a conversions
+# directory under CALIBRE_TEMP_DIR), up to CONVERSION_CACHE_SIZE bytes, the
+# least recently used dropped first. Converting the same file to the same
+# format again, with the same calibre and options, uses the stored copy. 0
+# disables the cache
+CONVERSION_CACHE_DIR = ''
+CONVERSION_CACHE_SIZE = 2 * 1024 ** 3
+
+# Uploads, conversions and page count scans are queued as jobs in the job log
+# database, and run by a job consumer: the uWSGI mule of calibre_webui.ini, or
+# `python -m calibre_webui.worker`. JOB_CONSUMER_EMBEDDED runs one in each web
+# process instead, for setups without either (e.g. the Flask dev server).
+# A consumer runs at most JOB_WORKERS jobs at once, at most JOB_LIMITS[kind]
+# of a kind. Uploads and conversions asked for go before automatic conversions,
+# and those before scans. The jobs of a consumer that stopped are run again
+# JOB_LEASE seconds later
+JOB_CONSUMER_EMBEDDED = False
+JOB_WORKERS = 4
+JOB_LIMITS = {'import': 2, 'import_batch': 1, 'convert': 1, 'scan': 1,
+        'thumbnails': 1}
+JOB_LEASE = 60
+
+# Book files dropped into INBOX_DIR are imported by the job consumer, then
+# removed, or moved to INBOX_DIR/.failed when calibredb did not add them. It
+# looks for them every INBOX_POLL_INTERVAL seconds, and adds up to
+# INBOX_BATCH_SIZE of them with each calibredb command. Files still being
+# written are left for the next look. Empty to disable
+INBOX_DIR = ''
+INBOX_POLL_INTERVAL = 10
+INBOX_BATCH_SIZE = 100
+
+# Finished jobs are dropped from the job log after JOB_LOG_RETENTION_DAYS, or
+# when more than JOB_LOG_MAX_ROWS of them are kept
+JOB_LOG_RETENTION_DAYS = 30
+JOB_LOG_MAX_ROWS = 1000
+
+# Pages follow the tasks through a stream of server-sent events, held by a
+# thread of a uWSGI process (see threads in calibre_webui.ini). Each process
+# serves at most TASKS_STREAM_MAX of them, pages falling back to polling past
+# that. A stream is closed and reopened every TASKS_STREAM_DURATION seconds
+TASKS_STREAM_MAX = 4
+TASKS_STREAM_DURATION = 300
+
+# Page counts found by a library scan are written this many books at a time,
+# in one transaction on the #pages column
+PAGE_COUNT_BATCH_SIZE = 500
+
+# Processes counting pages during a library scan, one per CPU when 0
+PAGE_SCAN_WORKERS = 0
@@ -1,18 +1,23 @@
 from flask import render_template, request, send_from_directory, send_file, \
-        jsonify, redirect, url_for, flash, abort
-from werkzeug.utils import secure_filename
-from urllib.parse import urljoin
-from PIL import Image
+        jsonify, redirect, url_for, flash, abort, Response, stream_with_context
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from urllib.parse import urljoin, quote
 import hashlib
+import json
 import os
 import re
 import shutil
+import threading
 import time
 import uuid
 
 from calibre_webui import app
 from calibre_webui.cover_placeholder import cover_placeholder_response
 from calibre_wrapper.calibredb import CalibreDBW
+from calibre_wrapper.uploads import save_upload, remove_upload
+from calibre_wrapper.thumbnails import THUMBNAIL_FORMATS, DEFAULT_SIZE
+from calibre_wrapper.epub_meta import RetitledEpub, EpubRewriteError, \
+        write_retitled_epub
 
 def flash_error(message):
     return flash(message, app.FLASH['error'])
@@ -70,33 +75,78 @@ def retitle_formats():
         value = value.split(',')
     return {fmt.strip().upper() for fmt in value if fmt.strip()}
 
-RETITLE_TEMP_PREFIX = 'retitle_'
-RETITLE_TEMP_MAX_AGE = 3600
+def file_offload():
+    value = (app.config.get('FILE_OFFLOAD') or '').strip().lower()
+    return value if value in ('nginx', 'sendfile') else None
+
+def offload_uri(path):
+    """Internal nginx location of a file, None when none of
+    FILE_OFFLOAD_LOCATIONS holds it."""
+    path = os.path.abspath(path)
+    for directory, location in app.config.get('FILE_OFFLOAD_LOCATIONS', {}).items():
+        directory = os.path.abspath(directory)
+        if os.path.commonpath([directory, path]) == directory:
+            return '%s/%s' % (location.rstrip('/'),
+                    quote(os.path.relpath(path, directory)))
+    return None
+
+def send_library_file(path, **kwargs):
+    """send_file, unless FILE_OFFLOAD is set: then only the headers are
+    sent, the web server in front being told to send the file itself,
+    ranges included."""
+    offload = file_offload()
+    target = None
+    if offload == 'nginx':
+        target = offload_uri(path)
+    elif offload == 'sendfile':
+        target = os.path.abspath(path)
+    if target is None:
+        return send_file(path, conditional=True, **kwargs)
+    # ranges are left to the web server
+    environ = {key: value for key, value in request.environ.items()
+            if key not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+    response = werkzeug_send_file(path, environ, conditional=True,
+            use_x_sendfile=True, max_age=app.get_send_file_max_age(path),
+            response_class=app.response_class, **kwargs)
+    del response.headers['X-Sendfile']
+    if response.status_code == 200:
+        response.headers['X-Accel-Redirect' if offload == 'nginx' else 'X-Sendfile'] = target
+    return response
+
+# seconds between two evictions from the retitled downloads cache
+RETITLE_CACHE_JANITOR_INTERVAL = 300
 
 def retitled_etag(source_stat, title):
     seed = '%s-%s-%s' % (source_stat.st_mtime, source_stat.st_size, title)
     return hashlib.sha1(seed.encode('utf-8')).hexdigest()
 
-def prune_retitled_temps(tmp_dir):
-    cutoff = time.time() - RETITLE_TEMP_MAX_AGE
-    try:
-        entries = list(os.scandir(tmp_dir))
-    except OSError:
-        return
-    for entry in entries:
-        if not entry.name.startswith(RETITLE_TEMP_PREFIX):
-            continue
+def retitle_copy(source, dest, title):
+    if source.lower().endswith('.epub'):
         try:
-            if entry.stat().st_mtime < cutoff:
-                os.remove(entry.path)
-        except OSError:
-            pass
+            write_retitled_epub(source, title, dest)
+            return
+        except EpubRewriteError as e:
+            print('falling back to ebook-meta for %s: %s' % (source, e), flush=True)
+    shutil.copyfile(source, dest)
+    app.calibredb_wrap.write_format_title(dest, title)
+
+def retitled_epub_response(source, title, **send_file_args):
+    """Streams the retitled EPUB straight from the source, or None when it
+    cannot be rewritten in process."""
+    try:
+        epub = RetitledEpub(source, title)
+    except (EpubRewriteError, OSError) as e:
+        print('falling back to ebook-meta for %s: %s' % (source, e), flush=True)
+        return None
+    response = send_file(epub, mimetype='application/epub+zip', conditional=True,
+            as_attachment=True, **send_file_args)
+    if response.status_code == 200:
+        response.content_length = epub.size
+    return response
 
 # API Endpoints
 
-@app.route('/api/books/list')
-def get_books():
-    page = int(request.args.get('page')) if 'page' in request.args else 1
+def search_args():
     search = request.args.get("search").strip().lower() \
             if 'search' in request.args else None
     scope = request.args.get('search_scope').strip() \
@@ -104,14 +154,31 @@ def get_books():
     read_status = request.args.get('read_status', '').strip().lower() or None
     if read_status not in ('read', 'unread'):
         read_status = None
+    return search or None, scope.lower() if scope else None, read_status
+
+@app.route('/api/books/list')
+def get_books():
+    page = int(request.args.get('page')) if 'page' in request.args else 1
+    search, scope, read_status = search_args()
     limit = request.args.get('limit', 21, type=int)
     limit = max(12, min(limit, 120))
-    books = app.calibredb_wrap.search_books(search.lower() if search else None,
-            scope.lower() if scope else None,
-            page=page, limit=limit, read_status=read_status)
-    if not books:
-        return jsonify([])
-    return jsonify([dict(book) for book in books])
+    try:
+        books, next_after = app.calibredb_wrap.search_books_page(
+                search, scope,
+                page=page, limit=limit, read_status=read_status,
+                after=request.args.get('after'))
+    except ValueError:
+        abort(400)
+    response = jsonify([dict(book) for book in books])
+    if next_after:
+        response.headers['X-Next-After'] = next_after
+    return response
+
+@app.route('/api/books/facets')
+def get_books_facets():
+    search, scope, read_status = search_args()
+    return jsonify(app.calibredb_wrap.search_facets(search, scope,
+        read_status=read_status))
 
 @app.route('/api/books/<int:book_id>/formats')
 def get_book_formats(book_id):
@@ -119,40 +186,128 @@ def get_book_formats(book_id):
 
 @app.route('/api/tasks/list')
 def get_tasks_list():
-    tasks = app.calibredb_wrap.list_tasks()
+    # the most recent tasks, ?before=<id> pages back from an older one
+    limit = max(1, min(request.args.get('limit', 200, type=int), 1000))
+    tasks = app.calibredb_wrap.list_tasks(limit,
+            request.args.get('before', type=int))
     return jsonify(tasks)
 
 @app.route('/api/books/scan_pages', methods=['POST'])
 def scan_pages():
-    app.calibredb_wrap.scan_all_pages()
+    mode = request.args.get('mode', 'full')
+    if mode not in ('full', 'incremental'):
+        abort(400)
+    app.calibredb_wrap.scan_all_pages(
+            dry_run=request.args.get('dry_run', '') in ('1', 'true'), mode=mode)
     return jsonify({'queued': True})
 
+@app.route('/api/thumbnails/generate', methods=['POST'])
+def generate_thumbnails():
+    days = request.args.get('days', '')
+    try:
+        days = float(days) if days else None
+    except ValueError:
+        abort(400)
+    task_id = app.calibredb_wrap.generate_thumbnails(days)
+    return jsonify({'queued': True, 'id': task_id})
+
 @app.route('/api/tasks/count')
 def get_tasks_count():
     return jsonify(app.calibredb_wrap.tasks_count())
 
-@app.route('/api/tasks/clear')
+# each stream holds a thread of its process, past this number pages fall
+# back to polling
+tasks_streams = threading.BoundedSemaphore(int(app.config.get('TASKS_STREAM_MAX', 4)))
+
+def sse_event(event, data, event_id=None):
+    return '%sevent: %s\ndata: %s\n\n' % ('id: %d\n' % event_id if event_id else '',
+            event, json.dumps(data))
+
+@app.route('/api/tasks/stream')
+def get_tasks_stream():
+    """Server-sent events: `task` for each task queued, updated or ended,
+    and `count` with the counts of /api/tasks/count whenever they may have
+    changed. A reconnecting client (Last-Event-ID) gets the changes it
+    missed. The stream ends after TASKS_STREAM_DURATION seconds, for the
+    client to reconnect."""
+    if not tasks_streams.acquire(blocking=False):
+        abort(503)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    duration = int(app.config.get('TASKS_STREAM_DURATION', 300))
+
+    def events(since):
+        yield 'retry: 5000\n\n'
+        if since is None:
+            since = app.calibredb_wrap.tasks_version()
+        watcher = app.calibredb_wrap.watch_tasks()
+        end = time.monotonic() + duration
+        last_sent = time.monotonic()
+        try:
+            while time.monotonic() < end:
+                # nothing but a PRAGMA while no task changes
+                if watcher.changed():
+                    for task in app.calibredb_wrap.task_changes(since):
+                        since = task['version']
+                        yield sse_event('task', task, since)
+                    yield sse_event('count', app.calibredb_wrap.tasks_count())
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= 15:
+                    # finds out about clients gone away
+                    yield ': keepalive\n\n'
+                    last_sent = time.monotonic()
+                time.sleep(1)
+        finally:
+            watcher.close()
+
+    response = Response(stream_with_context(events(since)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(tasks_streams.release)
+    return response
+
+@app.route('/api/tasks/clear', methods=['POST'])
 def clear_tasks():
-    app.calibredb_wrap.clear_tasks()
+    app.calibredb_wrap.clear_tasks(finished_only=True)
     return jsonify({'status': 'ok'})
 
+@app.route('/api/tasks/<int:task_id>/cancel', methods=['POST'])
+def cancel_task(task_id):
+    if not app.calibredb_wrap.cancel_task(task_id):
+        abort(404)
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/cache/stats')
+def get_cache_stats():
+    return jsonify(app.calibredb_wrap.cache_stats())
+
+def attributes_list(list_fn, count_fn, page):
+    # the total goes in a header so the body stays the plain list it was
+    page = max(1, request.args.get('page', page, type=int))
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    prefix = request.args.get('q', '').strip() or None
+    response = jsonify(list_fn(limit=limit, page=page, prefix=prefix))
+    response.headers['X-Total-Count'] = str(count_fn(prefix=prefix))
+    return response
+
 @app.route('/api/authors/list', defaults={'page': 1})
 @app.route('/api/authors/list/<int:page>')
 def get_authors_list(page):
-    authors = app.calibredb_wrap.list_authors()
-    return jsonify(authors)
+    return attributes_list(app.calibredb_wrap.list_authors,
+            app.calibredb_wrap.count_authors, page)
 
 @app.route('/api/tags/list', defaults={'page': 1})
 @app.route('/api/tags/list/<int:page>')
 def get_tags_list(page):
-    tags = app.calibredb_wrap.list_tags()
-    return jsonify(tags)
+    return attributes_list(app.calibredb_wrap.list_tags,
+            app.calibredb_wrap.count_tags, page)
 
 @app.route('/api/series/list', defaults={'page': 1})
 @app.route('/api/series/list/<int:page>')
 def get_series_list(page):
-    series = app.calibredb_wrap.list_series()
-    return jsonify(series)
+    return attributes_list(app.calibredb_wrap.list_series,
+            app.calibredb_wrap.count_series, page)
 
 # File serving
 
@@ -172,13 +327,7 @@ def static_img(path):
 
 @app.route('/', methods=['GET'])
 def index():
-    search = request.args.get("search").strip().lower() \
-            if 'search' in request.args else None
-    scope = request.args.get('search_scope').strip() \
-            if 'search_scope' in request.args else None
-    read_status = request.args.get('read_status', '').strip().lower() or None
-    if read_status not in ('read', 'unread'):
-        read_status = None
+    search, scope, read_status = search_args()
     return render_template('index.html', search=search,
             scope=scope, read_status=read_status, title='My Books',
             calibre_version=CalibreDBW.get_calibre_version())
@@ -243,9 +392,16 @@ def device_feed(device_id, page=1):
     if not device:
         return redirect(url_for("device_register"))
     book_format = device.formats.upper()
-    books = app.calibredb_wrap.search_books(device.book_tags_filters, 'tags', book_format=book_format, page=page)
+    try:
+        books, next_after = app.calibredb_wrap.search_books_page(
+                device.book_tags_filters, 'tags', book_format=book_format,
+                page=page, after=request.args.get('after'))
+    except ValueError:
+        abort(400)
     return render_template('feed.html', books=books, title=device.name,
-            preferred_formats=book_format.split(','), page=page, device_id=device_id, calibre_version=CalibreDBW.get_calibre_version())
+            preferred_formats=book_format.split(','), page=page,
+            next_after=next_after, device_id=device_id,
+            calibre_version=CalibreDBW.get_calibre_version())
 
 @app.route('/feeds/<device_id>/books/<int:book_id>/file/<book_format>/')
 def device_feed_download_book_file(device_id, book_id, book_format):
@@ -271,7 +427,7 @@ def device_feed_get_thumb(device_id, book_id):
 # List views
 @app.route('/tasks')
 def list_tasks():
-    tasks = app.calibredb_wrap.list_tasks()
+    tasks = app.calibredb_wrap.list_tasks(200)
     return render_template('tasklist.html', tasklist=tasks,
             title='Tasks list', calibre_version=CalibreDBW.get_calibre_version())
 
@@ -377,6 +533,13 @@ def delete_book(book_id):
         flash_error('Could not delete book #%i' % book_id)
     return redirect(url_for("index"))
 
+def save_uploaded_file(file_storage):
+    """Streams an upload to a temporary file of its own, returns (path,
+    size, sha256)."""
+    ext = file_storage.filename.rsplit('.', 1)[-1].lower()
+    return save_upload(file_storage.stream, app.config['CALIBRE_TEMP_DIR'],
+            secure_filename(file_storage.filename) or 'upload.%s' % ext)
+
 @app.route('/books/<int:book_id>/formats/add', methods=['POST'])
 def add_format(book_id):
     if 'format_upload' in request.files:
@@ -385,15 +548,18 @@ def add_format(book_id):
             if len(ext) <= 1 or ext[-1].upper() not in app.config['CALIBRE_EXT_UP']:
                 flash_error('Could not add %s to library (Invalid file)' % format_file.filename)
                 return redirect(url_for("index"))
-            tmp_dir = app.config['CALIBRE_TEMP_DIR']
-            tmp_file = os.path.join(tmp_dir,  secure_filename(format_file.filename))
-            format_file.save(tmp_file)
+            tmp_file, size, digest = save_uploaded_file(format_file)
+            duplicate = app.calibredb_wrap.find_duplicate(size, digest)
+            if duplicate and duplicate[0] == book_id:
+                flash_warning('%s is already the %s of this book' % (format_file.filename, duplicate[1]))
+                remove_upload(tmp_file)
+                continue
             try:
                 app.calibredb_wrap.add_format(book_id, tmp_file)
                 flash_success('%s uploaded and added to library' % format_file.filename)
             except Exception:
                 flash_error('Could not add %s to library' % format_file.filename)
-            os.remove(tmp_file)
+            remove_upload(tmp_file)
         return redirect(url_for("book_edit", book_id=book_id))
     else:
         flash_error('Please select a file to upload')
@@ -402,16 +568,33 @@ def add_format(book_id):
 @app.route('/books/upload', methods=['POST'])
 def upload():
     if 'books_upload' in request.files:
+        uploads = []
+        # {sha256: filename} of this upload's files
+        digests = {}
         for book_file in request.files.getlist('books_upload'):
             ext = book_file.filename.split('.')
             if len(ext) <= 1 or ext[-1].upper() not in app.config['CALIBRE_EXT_UP']:
+                if uploads:
+                    app.calibredb_wrap.add_books_async(uploads, app.config.get('AUTOCONVERT', {}))
                 flash_error('Could not add %s to library (Invalid file)' % book_file.filename)
                 return redirect(url_for("index"))
-            tmp_dir = app.config['CALIBRE_TEMP_DIR']
-            tmp_file = os.path.join(tmp_dir, secure_filename(book_file.filename))
-            book_file.save(tmp_file)
-            app.calibredb_wrap.add_book_async(tmp_file, book_file.filename, app.config.get('AUTOCONVERT', {}))
-        flash_success('Upload queued — check Tasks for progress')
+            tmp_file, size, digest = save_uploaded_file(book_file)
+            if digest in digests:
+                flash_warning('%s is the same file as %s' % (book_file.filename, digests[digest]))
+                remove_upload(tmp_file)
+                continue
+            duplicate = app.calibredb_wrap.find_duplicate(size, digest)
+            if duplicate:
+                book = app.calibredb_wrap.get_book(duplicate[0])
+                flash_warning('%s is already in the library as « %s » (%s)' % (book_file.filename,
+                    book['title'] if book else duplicate[0], duplicate[1]))
+                remove_upload(tmp_file)
+                continue
+            digests[digest] = book_file.filename
+            uploads.append([tmp_file, book_file.filename])
+        if uploads:
+            app.calibredb_wrap.add_books_async(uploads, app.config.get('AUTOCONVERT', {}))
+            flash_success('Upload queued — check Tasks for progress')
         return redirect(url_for("index"))
     else:
         flash_error('Please select a file to upload')
@@ -428,45 +611,51 @@ def convert_book(book_id):
 @app.route('/books/<int:book_id>/cover')
 def get_cover(book_id):
     book = app.calibredb_wrap.get_book_cover_info(book_id)
-    if book and book.has_cover:
-        book_dir = os.path.join(app.config['CALIBRE_LIBRARY_PATH'], book.path)
+    if book and book['has_cover']:
+        book_dir = os.path.join(app.config['CALIBRE_LIBRARY_PATH'], book['path'])
         if os.path.exists(os.path.join(book_dir, 'cover.jpg')):
-            return send_from_directory(book_dir, 'cover.jpg')
+            return send_library_file(os.path.join(book_dir, 'cover.jpg'))
     return cover_placeholder_response(book_id,
-                                      title=getattr(book, 'title', None) if book else None,
-                                      authors=getattr(book, 'authors', None) if book else None)
+                                      title=book['title'] if book else None,
+                                      authors=book['authors'] if book else None)
 
-THUMB_HEIGHT = 400
+def thumbnail_ext():
+    # */* is no promise of WebP support, e-readers send it
+    accepted = set(request.accept_mimetypes.values())
+    for ext in app.calibredb_wrap.thumbnails.formats:
+        if THUMBNAIL_FORMATS[ext][1] in accepted:
+            return ext
+    return 'jpg'
 
 @app.route('/books/<int:book_id>/thumb')
 def get_thumb(book_id):
     book = app.calibredb_wrap.get_book_cover_info(book_id)
-    if not book or not book.has_cover:
+    if not book or not book['has_cover']:
         return cover_placeholder_response(book_id,
-                                          title=getattr(book, 'title', None) if book else None,
-                                          authors=getattr(book, 'authors', None) if book else None)
-
-    book_dir = os.path.join(app.config['CALIBRE_LIBRARY_PATH'], book.path)
-    thumb_path = os.path.join(book_dir, 'thumb.jpg')
-
-    if not os.path.exists(thumb_path):
-        cover_path = os.path.join(book_dir, 'cover.jpg')
-        if not os.path.exists(cover_path):
-            return cover_placeholder_response(book_id, title=book.title, authors=book.authors)
-        try:
-            img = Image.open(cover_path)
-            ratio = THUMB_HEIGHT / img.height
-            img = img.resize((int(img.width * ratio), THUMB_HEIGHT), Image.LANCZOS)
-            img.save(thumb_path, 'JPEG', quality=80)
-        except Exception:
-            return send_from_directory(book_dir, 'cover.jpg')
-
-    return send_from_directory(book_dir, 'thumb.jpg')
+                                          title=book['title'] if book else None,
+                                          authors=book['authors'] if book else None)
+
+    cover_path = os.path.join(app.config['CALIBRE_LIBRARY_PATH'], book['path'], 'cover.jpg')
+    if not os.path.exists(cover_path):
+        return cover_placeholder_response(book_id, title=book['title'], authors=book['authors'])
+    size = request.args.get('size', DEFAULT_SIZE)
+    if size not in app.calibredb_wrap.thumbnails.sizes:
+        size = DEFAULT_SIZE
+    try:
+        thumb_path = app.calibredb_wrap.thumbnails.get(book_id, cover_path, size, thumbnail_ext())
+    except Exception as e:
+        print('could not make thumbnail of book %s: %s' % (book_id, e), flush=True)
+        return send_library_file(cover_path)
+    response = send_library_file(thumb_path)
+    response.vary.add('Accept')
+    return response
 
 @app.route('/books/<int:book_id>/file/<book_format>/')
 def download_book_file(book_id, book_format):
     book_format = book_format.upper()
-    location = app.calibredb_wrap.get_book_file(book_id, book_format)
+    book = app.calibredb_wrap.get_book(book_id)
+    location = app.calibredb_wrap.format_location(book, book_format) \
+            if book else None
     if not location:
         abort(404)
     fpath, fname = location
@@ -474,48 +663,66 @@ def download_book_file(book_id, book_format):
     if not sep:
         stem, ext = fname, ''
 
-    info = app.calibredb_wrap.get_book_title_info(book_id) \
-            if retitle_enabled() else None
-    if not info or not info.series:
-        return send_from_directory(fpath, fname, conditional=True,
+    source = os.path.join(fpath, fname)
+    if not retitle_enabled() or not book['series']:
+        return send_library_file(source,
                 download_name=safe_download_name(stem, ext, fname),
                 as_attachment=True)
 
-    title = display_title(info.title, info.series, info.series_index)
-    download_name = safe_download_name('%s - %s' % (title, info.authors)
-            if info.authors else title, ext, fname)
+    title = display_title(book['title'], book['series'], book['series_index'])
+    authors = ' & '.join(book['authors'].split(';')) if book['authors'] else ''
+    download_name = safe_download_name('%s - %s' % (title, authors)
+            if authors else title, ext, fname)
 
     if book_format not in retitle_formats():
-        return send_from_directory(fpath, fname, conditional=True,
-                download_name=download_name, as_attachment=True)
+        return send_library_file(source, download_name=download_name,
+                as_attachment=True)
 
-    source = os.path.join(fpath, fname)
-    tmp_dir = app.config['CALIBRE_TEMP_DIR']
-    prune_retitled_temps(tmp_dir)
-    tmp_file = os.path.join(tmp_dir, '%s%s_%i.%s' % (RETITLE_TEMP_PREFIX,
-        book_id, uuid.uuid4().fields[1], ext.lower()))
+    # the rewrite is deterministic, so deriving validators from the source file
+    # keeps them stable across requests and lets an interrupted download resume
+    source_stat = os.stat(source)
+    etag = retitled_etag(source_stat, title)
+    cache = app.retitle_cache
+    key = '%s_%d' % (etag, book_id)
+    cached = cache.lookup(key, ext or 'bin') if cache.enabled else None
+    if cached is None and book_format == 'EPUB' and not request.range \
+            and not (file_offload() and cache.enabled):
+        # ranges, and offloaded downloads, are served from a retitled copy,
+        # the rest streamed
+        response = retitled_epub_response(source, title, download_name=download_name,
+                last_modified=source_stat.st_mtime, etag=etag)
+        if response is not None:
+            return response
+    tmp_file = None
     try:
-        shutil.copyfile(source, tmp_file)
-        app.calibredb_wrap.write_format_title(tmp_file, title)
+        if cached is not None:
+            retitled = cached
+        elif cache.enabled:
+            cache.start_janitor(RETITLE_CACHE_JANITOR_INTERVAL)
+            retitled, _ = cache.fetch(key, ext or 'bin',
+                    lambda path: retitle_copy(source, path, title))
+        else:
+            retitled = tmp_file = os.path.join(app.config['CALIBRE_TEMP_DIR'],
+                    'retitle_%s_%i.%s' % (book_id, uuid.uuid4().fields[1], ext.lower()))
+            retitle_copy(source, tmp_file, title)
     except Exception as e:
         print('could not retitle book %s (%s): %s' % (book_id, book_format, e),
                 flush=True)
-        if os.path.exists(tmp_file):
+        if tmp_file and os.path.exists(tmp_file):
             os.remove(tmp_file)
-        return send_from_directory(fpath, fname, conditional=True,
-                download_name=download_name, as_attachment=True)
+        return send_library_file(source, download_name=download_name,
+                as_attachment=True)
 
-    # the rewrite is deterministic, so deriving validators from the source file
-    # keeps them stable across requests and lets an interrupted download resume;
-    # werkzeug would otherwise stat the throwaway copy and change them every time
-    source_stat = os.stat(source)
-    response = send_file(tmp_file, conditional=True, as_attachment=True,
+    if not tmp_file:
+        return send_library_file(retitled, as_attachment=True,
+                download_name=download_name,
+                last_modified=source_stat.st_mtime, etag=etag)
+    response = send_file(retitled, conditional=True, as_attachment=True,
             download_name=download_name,
-            last_modified=source_stat.st_mtime,
-            etag=retitled_etag(source_stat, title))
-    # send_file sets direct_passthrough, which makes werkzeug skip the response
-    # close callbacks entirely; unlinking the already-open file is the only
-    # cleanup that survives an aborted download (POSIX keeps the fd valid)
+            last_modified=source_stat.st_mtime, etag=etag)
+    # send_file sets direct_passthrough, which makes werkzeug skip the
+    # response close callbacks entirely; unlinking the already-open file is
+    # the only cleanup that survives an aborted download
     os.remove(tmp_file)
     return response
 
@@ -0,0 +1,34 @@
+"""Makes the missing cover thumbnails of the library.
+
+Books whose thumbnails are up to date are skipped, the others are made over
+a pool of THUMBNAIL_WORKERS processes.
+
+    python -m calibre_webui.thumbnails [--days N] [--queue]
+
+--queue leaves the work to the job consumer, which shows it in the task
+list."""
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=None,
+            help='only the books changed in the last DAYS days')
+    parser.add_argument('--queue', action='store_true',
+            help='queue a job instead of making them here')
+    args = parser.parse_args()
+    # imported here: process pool children run this module again
+    from calibre_webui import app
+
+    if args.queue:
+        print('queued task %d' % app.calibredb_wrap.generate_thumbnails(args.days))
+        return
+    print(app.calibredb_wrap.make_thumbnails(args.days,
+        progress=lambda message: print(message, flush=True)))
+
+
+if __name__ == '__main__':
+    # they run it from its path rather than import it by name, which would
+    # import calibre_webui and build the whole app in each of them
+    __spec__ = None
+    main()
@@ -0,0 +1,20 @@
+"""Job consumer of calibre_webui: runs the uploads, conversions and scans
+queued by the web processes.
+
+    python -m calibre_webui.worker
+
+or as a uWSGI mule, see calibre_webui.ini."""
+
+
+def main():
+    # imported here: process pool children run this module again
+    from calibre_webui import app
+
+    app.calibredb_wrap.run_jobs()
+
+
+if __name__ == '__main__':
+    # they run it from its path rather than import it by name, which would
+    # import calibre_webui and build the whole app in each of them
+    __spec__ = None
+    main()
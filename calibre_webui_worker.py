@@ -0,0 +1,5 @@
+# run as a uWSGI mule script as well as directly, but not when imported again
+# by the children of a process pool
+if __name__ != '__mp_main__':
+    from calibre_webui.worker import main
+    main()
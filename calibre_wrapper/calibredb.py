@@ -1,21 +1,45 @@
+import base64
+import json
 import subprocess
 import fcntl
 import unicodedata
-from sqlalchemy import create_engine, Table, MetaData, and_, event
+from contextlib import contextmanager
+from sqlalchemy import Table, MetaData, and_, bindparam, event
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import select, expression, or_, func
+from sqlalchemy.sql import select, expression, or_, func, type_coerce, null, \
+        literal, union_all
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.engine import Row
+from sqlalchemy.types import String
 from threading import Thread, RLock
 from tempfile import NamedTemporaryFile
 import re
 import os
+import time
 import uuid
 from . import logdb
 from .page_count import extract_page_count
-
-RE_ADDED_BOOK_ID = re.compile(r"^Added book ids: ([0-9]+)$")
+from .page_scan import PageScanDB, NO_FILE, file_signature, scan_pool
+from .conversion_cache import ConversionCache
+from .inbox import InboxWatcher
+from .uploads import FormatHashDB, file_digest, remove_upload, keep_failed_upload
+from .thumbnails import ThumbnailCache
+from .search_index import SearchIndex, SEARCH_SCHEMA, BOOK_FACETS, FACET_COUNTS, \
+        fts_query, comment_text
+from .library_cache import LibraryCache
+from .library_connection import create_library_engine, connect_writable
+from .calibredb_worker import CalibredbWorker, WorkerUnavailable
+from .scheduler import JobScheduler, JobCanceled, PRIORITY_INTERACTIVE, \
+        PRIORITY_FOLLOW_UP, PRIORITY_BACKGROUND, CANCEL_POLL_INTERVAL
+
+RE_ADDED_BOOK_IDS = re.compile(r"^Added book ids: ([0-9, ]+)$")
 RE_CALIBRE_VERSION = re.compile(r".*calibre ([0-9.]+).*")
+RE_EBOOK_META_TITLE = re.compile(r"^\s*Title\s*:\s?(.*)$", re.M)
+LOAD_CHUNK_SIZE = 500
+JOB_LIMITS = {'import': 2, 'import_batch': 1, 'convert': 1, 'scan': 1,
+        'thumbnails': 1}
+PAGE_COUNT_BATCH_SIZE = 500
+SEARCH_FACETS = ('formats', 'tags')
 
 
 def strip_accents(s):
@@ -24,17 +48,52 @@ def strip_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFKD', s)
                    if not unicodedata.combining(c))
 
+def parse_tags_filter(search):
+    include_tags, exclude_tags = [], []
+    for tag in (search or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('-'):
+            tag = tag[1:].strip()
+            if tag:
+                exclude_tags.append(tag)
+        elif tag:
+            include_tags.append(tag)
+    return include_tags, exclude_tags
+
+def encode_after(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode().rstrip('=')
+
+def decode_after(after, key_count):
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(after + '=' * (-len(after) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError('invalid pagination token: %s' % e)
+    if not isinstance(sort_values, list) or len(sort_values) != key_count or \
+            not all(isinstance(value, (str, int, float)) and not isinstance(value, bool)
+                for value in sort_values):
+        raise ValueError('invalid pagination token')
+    return sort_values
+
+def keyset_condition(sort_keys, sort_values):
+    # rows strictly after sort_values in the (column, descending) ordering
+    conditions = []
+    for i, (column, descending) in enumerate(sort_keys):
+        ties = [key == value for (key, _), value in zip(sort_keys[:i], sort_values[:i])]
+        after = column < sort_values[i] if descending else column > sort_values[i]
+        conditions.append(and_(*ties, after))
+    return or_(*conditions)
+
 class group_concat(expression.FunctionElement):
     name = "group_concat"
     inherit_cache = True
 
 
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        thread = Thread(target=fn, args=args, kwargs=kwargs)
-        thread.start()
-        return thread
-    return wrapper
+def config_flag(value):
+    # settings overridden from the environment come as strings
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
 
 @compiles(group_concat, 'sqlite')
 def group_concat_sqlite(element, compiler, **kw):
@@ -71,21 +130,59 @@ class CalibreDBW:
         self._config = config
         self._calibre_lib_dir = self._config['CALIBRE_LIBRARY_PATH']
         self._calibre_db = os.path.join(self._calibre_lib_dir, 'metadata.db')
-        self._db_ng = create_engine('sqlite:///%s' % self._calibre_db)
+        self._db_ng = create_library_engine(self._calibre_db, config)
+        self._search_index = SearchIndex(config)
+        self._cache = LibraryCache(self._calibre_db,
+                int(config.get('LIBRARY_CACHE_SIZE', 2048)))
 
         @event.listens_for(self._db_ng, 'connect')
         def _register_udfs(dbapi_conn, _):
             dbapi_conn.create_function('unaccent', 1, strip_accents, deterministic=True)
+            if self._search_index.available:
+                dbapi_conn.execute('ATTACH DATABASE ? AS %s' % SEARCH_SCHEMA,
+                        (self._search_index.db_path,))
 
         self._session = sessionmaker(self._db_ng)
+        self._statements = {}
         self._calibredb_lock = RLock()
         self._calibredb_lockfile = os.path.join(self._calibre_lib_dir, '.calibrewebui.lock')
-        self._scan_pages_lock = RLock()
-        self._scan_pages_running = False
+        self._calibredb_worker = CalibredbWorker(
+                config.get('CALIBREDB_WORKER_COMMAND') or None,
+                idle_timeout=int(config.get('CALIBREDB_WORKER_IDLE_TIMEOUT', 300))) \
+            if config_flag(config.get('CALIBREDB_WORKER', True)) else None
+        self._jobs = JobScheduler(config, int(config.get('JOB_WORKERS', 4)),
+                {kind: int(limit) for kind, limit
+                    in config.get('JOB_LIMITS', JOB_LIMITS).items()},
+                lease=int(config.get('JOB_LEASE', 60)),
+                retention_days=float(config.get('JOB_LOG_RETENTION_DAYS', 30)),
+                retention_rows=int(config.get('JOB_LOG_MAX_ROWS', 1000)))
+        self._jobs.register('import', self._add_book_job, self._remove_upload)
+        self._jobs.register('import_batch', self._add_books_job, self._remove_uploads)
+        self._jobs.register('convert', self._convert_book_job)
+        self._jobs.register('scan', self._scan_pages_job)
+        self._jobs.register('thumbnails', self._thumbnails_job)
+        self.thumbnails = ThumbnailCache(config.get('THUMBNAIL_CACHE_DIR')
+                    or os.path.join(config['CALIBRE_TEMP_DIR'], 'thumbnails'),
+                config.get('THUMBNAIL_SIZES'), int(config.get('THUMBNAIL_QUALITY', 80)))
+        self._format_hashes = FormatHashDB(config)
+        self._conversions = ConversionCache(config.get('CONVERSION_CACHE_DIR')
+                    or os.path.join(config['CALIBRE_TEMP_DIR'], 'conversions'),
+                int(config.get('CONVERSION_CACHE_SIZE', 2 * 1024 ** 3)))
         self._pages_column_id = None
         self._init_tables_metadata()
         self._ensure_pages_column()
-        self.clear_tasks()
+        if config_flag(config.get('JOB_CONSUMER_EMBEDDED', False)):
+            self._jobs.start()
+            self.watch_inbox_async()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self.refresh_search_index_async()
+
+    def _after_fork(self):
+        # uWSGI loads the app, which reads the library and starts syncing the
+        # search index, before forking its workers
+        self._db_ng.dispose(close=False)
+        self._cache.after_fork()
+        self._search_index.after_fork()
 
     def _ensure_pages_column(self):
         try:
@@ -114,10 +211,34 @@ class CalibreDBW:
             'custom_column_%d' % self._pages_column_id,
             MetaData(), autoload_with=self._db_ng)
 
-    def _run_calibredb(self, args):
+    def _statement(self, key, build):
+        # each query shape is built once, calls only bind their values so
+        # sqlalchemy runs the sql it already compiled for it
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements.setdefault(key, build())
+        return statement
+
+    def _execute(self, key, build, **params):
+        with self._db_ng.connect() as con:
+            return con.execute(self._statement(key, build), params).all()
+
+    @contextmanager
+    def _library_write_lock(self):
         with self._calibredb_lock:
             with open(self._calibredb_lockfile, 'w') as f:
                 fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def _run_calibredb(self, args):
+        with self._library_write_lock():
+            res = None
+            if self._calibredb_worker is not None:
+                try:
+                    res = self._calibredb_worker.run(args)
+                except WorkerUnavailable as e:
+                    print('%s, running calibredb directly' % e, flush=True)
+            if res is None:
                 res = subprocess.run(['calibredb'] + args, capture_output=True)
         if res.returncode != 0:
             err = 'error running cmd %s: %s' % (args, res.stderr.decode())
@@ -126,13 +247,67 @@ class CalibreDBW:
         return res
 
     def add_book(self, file_path):
-        res = self._run_calibredb(['add', '-d', file_path,
-            '--library-path', self._calibre_lib_dir])
+        return self.add_books([file_path])[0]
+
+    def add_books(self, file_paths):
+        """Adds the files as books with a single calibredb add, and returns
+        their ids in the same order, -1 for the files it did not add."""
+        res = self._run_calibredb(['add', '-d'] + list(file_paths) +
+            ['--library-path', self._calibre_lib_dir])
+        book_ids = []
         for line in res.stdout.decode().split('\n'):
-            m = re.match(RE_ADDED_BOOK_ID, line)
+            m = re.match(RE_ADDED_BOOK_IDS, line.strip())
             if m:
-                return m.group(1)
-        return -1
+                book_ids += [int(i) for i in m.group(1).split(',') if i.strip()]
+        # files are added in order, each given the next id
+        book_ids.sort()
+        if len(book_ids) == len(file_paths):
+            return book_ids
+        # which files failed is not told: each book added goes to the next
+        # file whose content it holds
+        print('calibredb added %d books out of %d files' % (len(book_ids),
+            len(file_paths)), flush=True)
+        result = []
+        for file_path in file_paths:
+            if book_ids and self._holds_file(book_ids[0], file_path):
+                result.append(book_ids.pop(0))
+            else:
+                result.append(-1)
+        return result
+
+    def _holds_file(self, book_id, file_path):
+        """Whether the book's format of the file's extension is that file."""
+        ext = file_path.rsplit('.', 1)[-1]
+        data = self._tables['Data']
+        with self._session() as session:
+            row = session.execute(select(data.c.name, data.c.uncompressed_size,
+                self._tables['books'].c.path)
+                .join_from(data, self._tables['books'], data.c.book == self._tables['books'].c.id)
+                .where(data.c.book == book_id, data.c.format == ext.upper())).first()
+        try:
+            if row is None or row.uncompressed_size != os.path.getsize(file_path):
+                return False
+            return self._format_hashes.digest(os.path.join(self._calibre_lib_dir,
+                row.path, '%s.%s' % (row.name, ext.lower()))) == file_digest(file_path)
+        except OSError:
+            return False
+
+    def find_duplicate(self, size, digest):
+        """(book_id, format) of a library file with this size and sha256, or
+        None. Only the files of the same size are hashed, and their hashes
+        are kept until they change."""
+        data = self._tables['Data']
+        with self._session() as session:
+            rows = session.execute(select(data.c.book, data.c.format, data.c.name,
+                self._tables['books'].c.path)
+                .join_from(data, self._tables['books'], data.c.book == self._tables['books'].c.id)
+                .where(data.c.uncompressed_size == size)).all()
+        for row in rows:
+            path = os.path.join(self._calibre_lib_dir, row.path,
+                    '%s.%s' % (row.name, row.format.lower()))
+            if self._format_hashes.digest(path) == digest:
+                return row.book, row.format
+        return None
 
     def add_format(self, book_id, file_path):
         self._run_calibredb(['add_format',
@@ -173,245 +348,674 @@ class CalibreDBW:
         command.append(str(book_id))
         self._run_calibredb(command)
 
-    def list_tasks(self):
-        return logdb.JobLogsDB(self._config).list_joblogs()
+    def list_tasks(self, limit=None, before=None):
+        return logdb.joblogs_db(self._config).list_joblogs(limit, before)
+
+    def task_changes(self, since):
+        """Tasks changed since the version `since`, each with the version of
+        its change, in the order they changed."""
+        return logdb.joblogs_db(self._config).joblog_changes(since)
 
-    def clear_tasks(self):
-        return logdb.JobLogsDB(self._config).clear_joblogs()
+    def tasks_version(self):
+        return logdb.joblogs_db(self._config).joblog_version()
+
+    def watch_tasks(self):
+        return logdb.joblogs_db(self._config).watcher()
+
+    def clear_tasks(self, finished_only=False):
+        return logdb.joblogs_db(self._config).clear_joblogs(finished_only)
+
+    def cancel_task(self, task_id):
+        return self._jobs.cancel(task_id)
 
     def tasks_count(self):
-        tasks = self.list_tasks()
+        counts = logdb.joblogs_db(self._config).count_joblogs()
         return {
-            'CANCELED':
-                sum(t['status'] == 'CANCELED' for t in tasks),
-            'RUNNING':
-                sum(t['status'] == 'RUNNING' for t in tasks),
-            'COMPLETED':
-                sum(t['status'] == 'COMPLETED' for t in tasks),
+            'CANCELED': counts.get('CANCELED', 0),
+            'RUNNING': counts.get('RUNNING', 0) + counts.get('CANCELING', 0),
+            'QUEUED': counts.get('QUEUED', 0),
+            'COMPLETED': counts.get('COMPLETED', 0),
             }
 
-    @threaded
+    def run_jobs(self):
+        """Consumes the queued jobs, forever."""
+        self.watch_inbox_async()
+        self._jobs.run()
+
+    def watch_inbox_async(self):
+        """Queues the import of the files dropped into INBOX_DIR, if set."""
+        inbox_dir = self._config.get('INBOX_DIR')
+        if not inbox_dir:
+            return None
+        autoconvert_config = self._config.get('AUTOCONVERT', {})
+        watcher = InboxWatcher(inbox_dir, self._config['CALIBRE_EXT_UP'],
+                lambda uploads: self.add_books_async(uploads, autoconvert_config),
+                interval=int(self._config.get('INBOX_POLL_INTERVAL', 10)),
+                batch_size=int(self._config.get('INBOX_BATCH_SIZE', 100)))
+        thread = Thread(target=watcher.run, daemon=True, name='inbox')
+        thread.start()
+        return thread
+
     def add_book_async(self, file_path, filename, autoconvert_config):
-        task_name = 'Upload book « %s »' % filename
-        task_id = logdb.JobLogsDB(self._config).push_joblog(task_name, 'RUNNING')
+        return self._jobs.submit('import', 'Upload book « %s »' % filename,
+                file_path, filename, autoconvert_config, priority=PRIORITY_INTERACTIVE)
+
+    def add_books_async(self, uploads, autoconvert_config):
+        """Queues the import of [[file_path, filename], ...] in one go."""
+        if not uploads:
+            return None
+        if len(uploads) == 1:
+            return self.add_book_async(*uploads[0], autoconvert_config)
+        return self._jobs.submit('import_batch', 'Upload %d books (« %s », ...)'
+                % (len(uploads), uploads[0][1]), uploads, autoconvert_config,
+                priority=PRIORITY_INTERACTIVE)
+
+    def _remove_upload(self, file_path, filename, autoconvert_config):
+        remove_upload(file_path)
+
+    def _remove_uploads(self, uploads, autoconvert_config):
+        for file_path, _ in uploads:
+            remove_upload(file_path)
+
+    def _add_book_job(self, job, file_path, filename, autoconvert_config):
+        self._add_books_job(job, [[file_path, filename]], autoconvert_config)
+
+    def _add_books_job(self, job, uploads, autoconvert_config):
+        book_ids = self.add_books([file_path for file_path, _ in uploads])
+        added = [(book_id, filename.rsplit('.', 1)[-1].upper())
+                for book_id, (_, filename) in zip(book_ids, uploads) if book_id > 0]
+        failed = []
+        for book_id, (file_path, filename) in zip(book_ids, uploads):
+            if book_id > 0:
+                continue
+            failed.append(filename)
+            try:
+                keep_failed_upload(file_path)
+            except OSError as e:
+                print('could not keep %s: %s' % (file_path, e), flush=True)
+        failed_message = 'not added: %s%s' % (', '.join(failed[:5]),
+                ', ...' if len(failed) > 5 else '')
+        if not added:
+            raise RuntimeError('calibredb did not add %d books, %s' % (len(uploads),
+                failed_message))
+        counts = {}
+        for book_id, ext in added:
+            book = self.get_book(book_id)
+            if book is None or book['page_count'] is not None:
+                continue
+            try:
+                count = self._extract_page_count(book, ext)
+            except Exception as e:
+                print('page count failed for book %s: %s' % (book_id, e), flush=True)
+                continue
+            counts[book_id] = count if count else 0
         try:
-            book_id = self.add_book(file_path)
-            logdb.JobLogsDB(self._config).update_joblog(task_id, task_name, 'COMPLETED')
-            ext = filename.rsplit('.', 1)[-1].upper()
+            self.set_page_counts(counts)
+        except Exception as e:
+            print('set_page_counts failed for books %s: %s' % (list(counts), e),
+                    flush=True)
+        for book_id, _ in added:
             try:
-                self.ensure_page_count(book_id, ext)
+                self.make_book_thumbnails(book_id)
             except Exception as e:
-                print('ensure_page_count failed for book %s: %s' % (book_id, e), flush=True)
+                print('thumbnails failed for book %s: %s' % (book_id, e), flush=True)
+        for book_id, ext in added:
             if ext in autoconvert_config:
-                self.convert_book(book_id, ext, autoconvert_config[ext])
-        except Exception:
-            logdb.JobLogsDB(self._config).update_joblog(task_id, task_name, 'CANCELED')
-        finally:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+                self.convert_book(book_id, ext, autoconvert_config[ext],
+                        priority=PRIORITY_FOLLOW_UP)
+        if failed:
+            return 'Uploaded %d books out of %d, %s' % (len(added), len(uploads),
+                    failed_message)
+        if len(uploads) > 1:
+            return 'Uploaded %d books' % len(added)
 
     def ensure_page_count(self, book_id, fmt_hint=None, force=False):
+        book = self.get_book(book_id)
+        if not book:
+            return None
         if not force:
-            current = self.get_page_count(book_id)
+            current = book['page_count']
             if current is not None:
                 return current if current > 0 else None
+        count = self._extract_page_count(book, fmt_hint)
+        self.set_page_count(book_id, count if count else 0)
+        return count
+
+    def _extract_page_count(self, book, fmt_hint=None):
         fmt = fmt_hint.upper() if fmt_hint else None
         if fmt not in ('PDF', 'EPUB'):
-            fmt = self._pick_pageable_format(book_id)
-        count = None
+            fmt = self._pick_pageable_format(book)
         if fmt:
-            location = self.get_book_file(book_id, fmt)
+            location = self.format_location(book, fmt)
             if location:
                 fpath, fname = location
-                count = extract_page_count(os.path.join(fpath, fname), fmt)
-        self.set_page_count(book_id, count if count else 0)
-        return count
+                return extract_page_count(os.path.join(fpath, fname), fmt)
+        return None
+
+    def scan_all_pages(self, dry_run=False, mode='full'):
+        """Counts the pages of every book, over a pool of processes.
+
+        An incremental scan skips the books whose file is the one their
+        stored count was taken from, same path, size and mtime. Returns the
+        id of the scan job, the one already queued or running if any."""
+        return self._jobs.submit('scan',
+                'Page count dry run' if dry_run else 'Scanning page counts',
+                dry_run, mode, priority=PRIORITY_BACKGROUND, dedupe_key='scan')
+
+    def _scan_pages_job(self, job, dry_run, mode):
+        batch_size = max(1, int(self._config.get('PAGE_COUNT_BATCH_SIZE',
+            PAGE_COUNT_BATCH_SIZE)))
+        scan_db = PageScanDB(self._config)
+        known = scan_db.signatures()
+        targets = sorted(self.list_all_book_ids())
+        total = len(targets)
+        done = scanned = changed = scanned_bytes = 0
+        pending, signatures = {}, {}
+        start = last_progress = time.monotonic()
+
+        def progress():
+            elapsed = max(time.monotonic() - start, 1e-6)
+            return '%d/%d, %d scanned, %.1f books/s, %.1f MB/s' % (done, total,
+                    scanned, scanned / elapsed, scanned_bytes / elapsed / 1e6)
+
+        def flush():
+            self.set_page_counts(pending)
+            scan_db.save(signatures)
+            pending.clear()
+            signatures.clear()
 
-    @threaded
-    def scan_all_pages(self):
-        with self._scan_pages_lock:
-            if self._scan_pages_running:
-                return
-            self._scan_pages_running = True
-        log = logdb.JobLogsDB(self._config)
-        task_name = 'Scanning page counts'
-        task_id = log.push_joblog(task_name, 'RUNNING')
         try:
-            targets = sorted(self.list_all_book_ids())
-            total = len(targets)
-            done = 0
-            written = 0
-            for book_id in targets:
-                try:
-                    if self.ensure_page_count(book_id, force=True):
-                        written += 1
-                except Exception as e:
-                    print('ensure_page_count failed for %s: %s' % (book_id, e), flush=True)
-                done += 1
-                if done % 10 == 0 or done == total:
-                    log.update_joblog(task_id,
-                        '%s: %d/%d' % (task_name, done, total), 'RUNNING')
-            log.update_joblog(task_id,
-                'Scanned page counts: wrote %d of %d' % (written, total), 'COMPLETED')
-        except Exception as e:
-            print('scan_all_pages failed: %s' % e, flush=True)
-            log.update_joblog(task_id, '%s (failed)' % task_name, 'CANCELED')
+            with scan_pool(int(self._config.get('PAGE_SCAN_WORKERS', 0))) as pool:
+                for i in range(0, total, LOAD_CHUNK_SIZE):
+                    # loaded around the cache, a full scan would only evict
+                    # what the readers are using
+                    books = self._load_books(targets[i:i + LOAD_CHUNK_SIZE])
+                    counts = []
+                    for book in books:
+                        fmt = self._pick_pageable_format(book)
+                        location = self.format_location(book, fmt) if fmt else None
+                        signature = file_signature(os.path.join(*location)
+                                if location else None)
+                        if mode == 'incremental' and book['page_count'] is not None \
+                                and known.get(book['id']) == signature:
+                            continue
+                        counts.append((book, signature, pool.submit(extract_page_count,
+                            signature[0], fmt) if signature != NO_FILE else None))
+                    done += len(targets[i:i + LOAD_CHUNK_SIZE]) - len(counts)
+                    for book, signature, count in counts:
+                        job.check_canceled()
+                        done += 1
+                        try:
+                            count = (count.result() if count else None) or 0
+                        except Exception as e:
+                            print('page count failed for %s: %s' % (book['id'], e),
+                                    flush=True)
+                            continue
+                        scanned += 1
+                        scanned_bytes += signature[1]
+                        if count != book['page_count']:
+                            changed += 1
+                            if dry_run:
+                                print('book %d: page count %s would become %d'
+                                        % (book['id'], book['page_count'], count), flush=True)
+                            else:
+                                pending[book['id']] = count
+                        if not dry_run:
+                            signatures[book['id']] = signature
+                        if len(pending) >= batch_size:
+                            flush()
+                        if time.monotonic() - last_progress >= 2:
+                            last_progress = time.monotonic()
+                            job.progress('%s: %s' % (job.name, progress()))
+                    job.check_canceled()
         finally:
-            with self._scan_pages_lock:
-                self._scan_pages_running = False
+            # whatever was counted is kept, even when canceled
+            flush()
+        if not dry_run:
+            scan_db.forget(set(known) - set(targets))
+            return 'Scanned page counts: wrote %d, %s' % (changed, progress())
+        return 'Page count dry run: %d would change, %s' % (changed, progress())
+
+    def generate_thumbnails(self, days=None):
+        """Queues the making of the missing cover thumbnails, of every book
+        or of those changed in the last days. Returns the id of the job, the
+        one already queued or running if any."""
+        return self._jobs.submit('thumbnails', 'Generating thumbnails%s'
+                % (' of the last %g days' % days if days else ''), days,
+                priority=PRIORITY_BACKGROUND, dedupe_key='thumbnails')
+
+    def _thumbnails_job(self, job, days):
+        return self.make_thumbnails(days, job.check_canceled,
+                lambda message: job.progress('%s: %s' % (job.name, message)))
+
+    def make_thumbnails(self, days=None, check_canceled=None, progress=None):
+        """Makes the missing cover thumbnails over a pool of processes,
+        reporting progress every 2s. Returns the final report."""
+        covers = self._covers(days)
+        total = len(covers)
+        done = made = failed = 0
+        start = last_progress = time.monotonic()
+
+        def report():
+            return '%d/%d, %d made, %d failed, %.1f books/s' % (done, total, made,
+                    failed, made / max(time.monotonic() - start, 1e-6))
+
+        with scan_pool(int(self._config.get('THUMBNAIL_WORKERS', 0))) as pool:
+            for i in range(0, total, LOAD_CHUNK_SIZE):
+                pending = []
+                for book_id, cover_path in covers[i:i + LOAD_CHUNK_SIZE]:
+                    try:
+                        missing = self.thumbnails.missing(book_id, cover_path)
+                    except OSError:
+                        # no cover file after all
+                        missing = None
+                    if missing:
+                        pending.append((book_id, pool.submit(self.thumbnails.make,
+                            book_id, cover_path, missing)))
+                    else:
+                        done += 1
+                for book_id, future in pending:
+                    if check_canceled:
+                        check_canceled()
+                    done += 1
+                    try:
+                        future.result()
+                        made += 1
+                    except Exception as e:
+                        failed += 1
+                        print('thumbnails failed for book %s: %s' % (book_id, e),
+                                flush=True)
+                    if progress and time.monotonic() - last_progress >= 2:
+                        last_progress = time.monotonic()
+                        progress(report())
+        return 'Generated thumbnails: %s' % report()
+
+    def make_book_thumbnails(self, book_id):
+        book = self.get_book(book_id)
+        if book and book['has_cover']:
+            cover_path = os.path.join(self._calibre_lib_dir, book['path'], 'cover.jpg')
+            if os.path.exists(cover_path):
+                self.thumbnails.make(book_id, cover_path,
+                        self.thumbnails.missing(book_id, cover_path))
+
+    def _covers(self, days=None):
+        """[(book_id, cover path)] of the books with a cover, changed in the
+        last days if given."""
+        books = self._tables['books']
+        stm = select(books.c.id, books.c.path).where(books.c.has_cover == 1)
+        if days:
+            since = time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.gmtime(time.time() - float(days) * 86400))
+            stm = stm.where(type_coerce(books.c.last_modified, String) >= since)
+        with self._session() as session:
+            return [(row.id, os.path.join(self._calibre_lib_dir, row.path, 'cover.jpg'))
+                    for row in session.execute(stm.order_by(books.c.id))]
 
-    def _pick_pageable_format(self, book_id):
-        formats = {f['format'].upper() for f in self.get_book_formats(book_id)}
+    def _pick_pageable_format(self, book):
+        formats = {f['format'].upper() for f in book['formats']}
         for candidate in ('PDF', 'EPUB'):
             if candidate in formats:
                 return candidate
         return None
 
-    @threaded
-    def convert_book(self, book_id, format_from, format_to):
-        task_name = 'Convert book « %s » from %s to %s' \
-                    % (self.get_book_title(book_id), format_from, format_to)
-        task_id = logdb.JobLogsDB(self._config).push_joblog(task_name, 'RUNNING')
-        fpath, fname = self.get_book_file(book_id, format_from)
+    def convert_book(self, book_id, format_from, format_to,
+            priority=PRIORITY_INTERACTIVE):
+        book = self.get_book(book_id)
+        task_name = 'Convert book « %s » from %s to %s' \
+                    % (book['title'] if book else book_id, format_from, format_to)
+        return self._jobs.submit('convert', task_name, book_id, format_from,
+                format_to, priority=priority)
+
+    def _convert_book_job(self, job, book_id, format_from, format_to):
+        book = self.get_book(book_id)
+        fpath, fname = self.format_location(book, format_from)
         tmp_dir = self._config['CALIBRE_TEMP_DIR']
         tmp_file = os.path.join(tmp_dir, 'calibre_temp_%s_%i.%s' % (book_id,
             uuid.uuid4().fields[1], format_to.lower()))
         fullpath = os.path.join(fpath, fname)
+        options = list(self._config.get('CONVERSION_OPTIONS', {})
+                .get(format_to.upper(), []))
         try:
-            subprocess.run(['ebook-convert', fullpath, tmp_file], check=True)
+            if self._conversions.enabled:
+                key = self._conversions.key(fullpath, format_to,
+                        self.get_calibre_version(), options)
+                if self._conversions.convert(key, format_to, tmp_file,
+                        lambda output: self._ebook_convert(job, fullpath, output,
+                            options)):
+                    print('conversion of %s to %s found in cache' % (fname, format_to),
+                            flush=True)
+            else:
+                self._ebook_convert(job, fullpath, tmp_file, options)
+            job.check_canceled()
             if self.get_book(book_id) is None:
                 self.add_book(tmp_file)
             else:
                 self.add_format(book_id, tmp_file)
-            os.remove(tmp_file)
-            logdb.JobLogsDB(self._config).update_joblog(task_id, task_name, 'COMPLETED')
-        except Exception:
-            logdb.JobLogsDB(self._config).update_joblog(task_id, task_name, 'CANCELED')
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _ebook_convert(self, job, source, output, options):
+        process = subprocess.Popen(['ebook-convert', source, output] + options)
+        while True:
+            try:
+                process.wait(CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if job.canceled:
+                    process.kill()
+                    process.wait()
+                    raise JobCanceled()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
 
     def search_books(self, search, attribute, page=1, limit=21, book_format=None, read_status=None):
-        with self._session() as session:
-            formats = select(func.group_concat(self._tables['Data'].c.format, ','))\
-                .where(self._tables['Data'].c.book == self._tables['books'].c.id)\
-                .correlate(self._tables['books'])\
-                .scalar_subquery()\
-                .label('formats')
+        return self.search_books_page(search, attribute, page=page, limit=limit,
+                book_format=book_format, read_status=read_status)[0]
+
+    def search_books_page(self, search, attribute, page=1, limit=21,
+            book_format=None, read_status=None, after=None):
+        """Like search_books, also returning the `after` token of the next
+        page, or None on the last one. Passing it back as `after` resumes the
+        listing right after the current page whatever its depth, `page` is
+        then ignored."""
+        return self._cache.get(('search', search, attribute, page, limit,
+                book_format, read_status, after),
+            lambda: self._search_books_page(search, attribute, page, limit,
+                book_format, read_status, after))
+
+    def search_facets(self, search, attribute, book_format=None, read_status=None,
+            limit=20):
+        """Book counts per format and per tag among all the books a search
+        matches, the most frequent first, at most limit of each. Empty when
+        the search index is unavailable."""
+        return self._cache.get(('facets', search, attribute, book_format,
+                read_status, limit),
+            lambda: self._search_facets_counts(search, attribute, book_format,
+                read_status, limit))
+
+    def _search_facets_counts(self, search, attribute, book_format, read_status,
+            limit):
+        if not self.refresh_search_index():
+            return {}
+        shape, params = self._search_filter(search, attribute, book_format,
+                read_status)
+        rows = self._execute(('facets',) + shape,
+                lambda: self._build_facets_query(*shape), **params)
+        facets = {facet: [] for facet in SEARCH_FACETS}
+        for row in rows:
+            if len(facets[row.facet]) < limit:
+                facets[row.facet].append({'name': row.name, 'count': row.book_count})
+        return facets
+
+    def _build_facets_query(self, *shape):
+        # counted on the facets kept with the search index, the matching
+        # books are only looked up once whatever the number of facets
+        matched, _ = self._build_search_filter(*shape)
+        book_count = func.count().label('book_count')
+        return select(BOOK_FACETS.c.facet, BOOK_FACETS.c.name, book_count)\
+                .where(BOOK_FACETS.c.facet.in_(SEARCH_FACETS))\
+                .where(BOOK_FACETS.c.book.in_(matched))\
+                .group_by(BOOK_FACETS.c.facet, BOOK_FACETS.c.name)\
+                .order_by(BOOK_FACETS.c.facet, book_count.desc(), BOOK_FACETS.c.name)
+
+    def _search_filter(self, search, attribute, book_format, read_status):
+        """(shape, params) of the filters of a search: shape picks the
+        statement, params are the values bound to it."""
+        # anything else searches titles and authors and sorts by date
+        attribute = attribute if attribute in ('authors', 'series', 'tags') else None
+        read_status = read_status if read_status in ('read', 'unread') else None
+        params = {}
+        search_mode = None
+        if search and attribute == 'tags':
+            search_mode = 'tags'
+            include_tags, exclude_tags = parse_tags_filter(search)
+            if include_tags:
+                params['include_tags'] = self._get_tag_ids(include_tags)
+            if exclude_tags:
+                params['exclude_tags'] = self._get_tag_ids(exclude_tags)
+        elif search:
+            params['fts_query'] = self._search_match(search, attribute)
+            if params['fts_query'] is not None:
+                search_mode = 'fts'
+            else:
+                search_mode = 'like'
+                params['pattern'] = '%%%s%%' % strip_accents(search)
+        if book_format:
+            params['formats'] = [f.upper() for f in book_format.split(',')]
+        if read_status:
+            params['read_tag'] = self._get_tag_ids(['read'])
+        return (attribute, search_mode, 'include_tags' in params,
+                'exclude_tags' in params, bool(book_format), read_status), params
+
+    def _search_books_page(self, search, attribute, page, limit, book_format,
+            read_status, after):
+        shape, params = self._search_filter(search, attribute, book_format,
+                read_status)
+        shape += (bool(after),)
+        params['limit'] = limit + 1
+        query = self._statement(('search',) + shape,
+                lambda: self._build_search_query(*shape))
+        # the id column is followed by the sort keys
+        key_count = len(query.selected_columns) - 1
+        if after:
+            params.update(('after_%d' % i, value) for i, value
+                    in enumerate(decode_after(after, key_count)))
+        else:
+            params['offset'] = (page - 1) * limit
+
+        with self._db_ng.connect() as con:
+            rows = con.execute(query, params).all()
+        next_after = encode_after([getattr(rows[limit - 1], 'sort_key_%d' % i)
+            for i in range(key_count)]) if len(rows) > limit else None
+
+        books = self.get_books([row.id for row in rows[:limit]])
+        result = []
+        for row in rows[:limit]:
+            book = books.get(row.id)
+            if not book:
+                continue
+            result.append({
+                'id': book['id'],
+                'title': book['title'],
+                'has_cover': book['has_cover'],
+                'formats': ','.join(f['format'] for f in book['formats']),
+                'authors': book['authors'],
+                'series': book['series'],
+                'series_index': book['series_index'],
+                'tags': book['tags'],
+                'read': len([tag for tag in (book['tags'] or '').split(',')
+                            if tag.strip().lower() == 'read']) > 0,
+            })
+        return result, next_after
+
+    def _build_search_query(self, attribute, search_mode, include_tags,
+            exclude_tags, book_format, read_status, after):
+        query, fts = self._build_search_filter(attribute, search_mode,
+                include_tags, exclude_tags, book_format, read_status)
+
+        last_modified = type_coerce(self._tables['books'].c.last_modified, String)
+        if attribute == 'series':
+            sort_keys = [(self._tables['books'].c.series_index, False),
+                    (self._tables['books'].c.id, False)]
+        elif fts is not None:
+            sort_keys = [(fts.c.rank, False), (last_modified, True),
+                    (self._tables['books'].c.id, True)]
+        else:
+            sort_keys = [(last_modified, True), (self._tables['books'].c.id, True)]
+        query = query.order_by(*[column.desc() if descending else column
+            for column, descending in sort_keys])
+        query = query.add_columns(*[column.label('sort_key_%d' % i)
+            for i, (column, _) in enumerate(sort_keys)])
+
+        if after:
+            query = query.where(keyset_condition(sort_keys,
+                [bindparam('after_%d' % i) for i in range(len(sort_keys))]))
+        else:
+            query = query.offset(bindparam('offset'))
+        # one extra row tells whether there is a next page
+        return query.limit(bindparam('limit'))
+
+    def _build_search_filter(self, attribute, search_mode, include_tags,
+            exclude_tags, book_format, read_status):
+        """Ids of the books matching a search, unordered, and the full-text
+        match subquery when there is one."""
+        author = select(group_concat(self._tables['authors'].c.name, ';'))\
+                .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
+                    self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
+                    .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
+                    .label('authors')
 
-            select_columns = [
-                self._tables['books'].c.title,
-                self._tables['books'].c.has_cover,
-                self._tables['books'].c.id,
-                formats
-            ]
-
-            author = select(group_concat(self._tables['authors'].c.name, ';'))\
-                    .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
-                        self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
-                        .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
-                        .label('authors')
-            select_columns.append(author)
-
-            series = select(self._tables['series'].c.name)\
-                    .select_from(self._tables['series'].join(self._tables['books_series_link'],
-                        self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
-                    .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
-                    .label('series')
-            select_columns.append(series)
-            select_columns.append(self._tables['books'].c.series_index)
-
-            tags = select(group_concat(self._tables['tags'].c.name, ', '))\
-                    .select_from(self._tables['tags'].join(self._tables['books_tags_link'],
-                        self._tables['books_tags_link'].c.tag == self._tables['tags'].c.id))\
-                    .where(self._tables['books_tags_link'].c.book == self._tables['books'].c.id)\
-                    .label('tags')
-            select_columns.append(tags)
-
-            query = select(*select_columns)
-            query = query.select_from(self._tables['books'].join(self._tables['Data'], self._tables['Data'].c.book == self._tables['books'].c.id))
-
-            if book_format:
-                format_conditions = [self._tables['Data'].c.format == f.upper()
-                                for f in book_format.split(',')]
-                query = query.where(or_(*format_conditions))
-
-            group_by_columns = [self._tables['books'].c.id, self._tables['books'].c.title, self._tables['books'].c.has_cover, series, self._tables['books'].c.series_index, author]
-            if not attribute or attribute == 'tags':
-                group_by_columns.append(tags)
-
-            query = query.group_by(*group_by_columns)
-
-            if search:
-                norm_search = strip_accents(search)
-                if attribute and attribute in ['authors', 'series', 'tags']:
-                    match attribute:
-                        case 'authors':
-                            query = query.where(func.unaccent(author).ilike(f'%{norm_search}%'))
-                        case 'series':
-                            query = query.where(func.unaccent(series).ilike(f'%{norm_search}%'))
-                        case 'tags':
-                            search_tags = search.split(',')
-                            include_tags = [tag for tag in search_tags if not tag.startswith('-')]
-                            exclude_tags = [tag[1:] for tag in search_tags if tag.startswith('-')]
-
-                            conditions = []
-                            if include_tags:
-                                conditions.append(or_(*[
-                                    or_(
-                                        tags == tag,
-                                        tags.like(f'{tag},%'),
-                                        tags.like(f'%, {tag},%'),
-                                        tags.like(f'%, {tag}')
-                                    )
-                                    for tag in include_tags
-                                ]))
-                            if exclude_tags:
-                                conditions.append(and_(*[
-                                    or_(
-                                        tags.is_(None),
-                                        ~or_(
-                                            tags == tag,
-                                            tags.like(f'{tag},%'),
-                                            tags.like(f'%, {tag},%'),
-                                            tags.like(f'%, {tag}')
-                                        )
-                                    )
-                                    for tag in exclude_tags
-                                ]))
-
-                            if conditions:
-                                query = query.where(and_(*conditions))
-                else:
+        series = select(self._tables['series'].c.name)\
+                .select_from(self._tables['series'].join(self._tables['books_series_link'],
+                    self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
+                .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
+                .label('series')
+
+        fts = SearchIndex.match() if search_mode == 'fts' else None
+        from_clause = self._tables['books']
+        if fts is not None:
+            from_clause = from_clause.join(fts, fts.c.book == self._tables['books'].c.id)
+
+        # only ids are selected here, the rows are then hydrated through
+        # get_books() which serves them from the cache when it can
+        query = select(self._tables['books'].c.id)
+        query = query.select_from(from_clause)
+
+        # books without any file are not listed
+        has_formats = select(self._tables['Data'].c.id)\
+                .where(self._tables['Data'].c.book == self._tables['books'].c.id)
+        if book_format:
+            has_formats = has_formats.where(self._tables['Data'].c.format.in_(
+                bindparam('formats', expanding=True)))
+        query = query.where(has_formats.exists())
+
+        if search_mode == 'like':
+            pattern = bindparam('pattern')
+            match attribute:
+                case 'authors':
+                    query = query.where(func.unaccent(author).ilike(pattern))
+                case 'series':
+                    query = query.where(func.unaccent(series).ilike(pattern))
+                case _:
                     query = query.where(
                         or_(
-                            func.unaccent(self._tables['books'].c.title).ilike(f'%{norm_search}%'),
-                            func.unaccent(author).ilike(f'%{norm_search}%')
+                            func.unaccent(self._tables['books'].c.title).ilike(pattern),
+                            func.unaccent(author).ilike(pattern)
                         )
                     )
 
-            if read_status in ('read', 'unread'):
-                read_match = or_(
-                    tags == 'read',
-                    tags.like('read,%'),
-                    tags.like('%, read,%'),
-                    tags.like('%, read'),
-                )
-                if read_status == 'read':
-                    query = query.where(read_match)
-                else:
-                    query = query.where(or_(tags.is_(None), ~read_match))
-
-            if attribute == 'series':
-                query = query.order_by(self._tables['books'].c.series_index)
-            else:
-                query = query.order_by(self._tables['books'].c.last_modified.desc())
+        # books must carry at least one of the included tags and none of the
+        # excluded ones; names are resolved to ids up front so the filters
+        # run on the books_tags_link indexes
+        if include_tags:
+            query = query.where(self._has_tags('include_tags'))
+        if exclude_tags:
+            query = query.where(~self._has_tags('exclude_tags'))
+        if read_status == 'read':
+            query = query.where(self._has_tags('read_tag'))
+        elif read_status == 'unread':
+            query = query.where(~self._has_tags('read_tag'))
+        return query, fts
+
+    def _get_tag_ids(self, names):
+        return [row.id for row in self._execute(('tag_ids',),
+            lambda: select(self._tables['tags'].c.id)
+                .where(self._tables['tags'].c.name.in_(bindparam('names', expanding=True))),
+            names=names)]
+
+    def _has_tags(self, tag_ids_param):
+        link = self._tables['books_tags_link']
+        return select(link.c.id)\
+                .where(link.c.book == self._tables['books'].c.id)\
+                .where(link.c.tag.in_(bindparam(tag_ids_param, expanding=True)))\
+                .exists()
+
+    def _search_match(self, search, attribute):
+        columns = {'authors': ['authors'], 'series': ['series']}.get(attribute)
+        query = fts_query(strip_accents(search), columns)
+        if query is None or not self.refresh_search_index():
+            return None
+        return query
 
-            query = query.limit(limit).offset((page - 1) * limit)
+    def cache_stats(self):
+        return self._cache.stats()
 
-            result = self.resultproxy_to_dict(session.execute(query).all())
-            result = [dict(book, **{
-                'read': len([tag for tag in (book.get('tags') or '').split(',')
-                            if tag.strip().lower() == 'read']) > 0
-            }) for book in result]
-            return result
+    def refresh_search_index(self):
+        """Whether the search index is up to date with the library, synced
+        when it is not. Callers fall back to querying the library without
+        it."""
+        if not self._search_index.available:
+            return False
+        try:
+            self._search_index.sync(self._cache.signature(),
+                    self._search_stamps, self._search_documents,
+                    self._search_facets)
+        except Exception as e:
+            # tried again by the next caller
+            print('search index sync failed: %s' % e, flush=True)
+            return False
+        return True
+
+    def refresh_search_index_async(self):
+        thread = Thread(target=self.refresh_search_index, daemon=True)
+        thread.start()
+        return thread
+
+    def _search_stamps(self):
+        rows = self._execute(('search_stamps',),
+            lambda: select(self._tables['books'].c.id,
+                type_coerce(self._tables['books'].c.last_modified, String).label('last_modified')))
+        return {row.id: row.last_modified for row in rows}
+
+    def _search_documents(self, book_ids):
+        rows = self._execute(('search_documents',), self._build_search_documents_query,
+                book_ids=book_ids)
+        return [(row.id, row.title, row.authors or '', row.series or '',
+                 row.tags or '', comment_text(row.comments))
+                for row in rows]
+
+    def _search_facets(self, book_ids):
+        return [tuple(row) for row in self._execute(('search_facets',),
+            self._build_search_facets_query, book_ids=book_ids)]
+
+    def _build_search_facets_query(self):
+        book_ids = bindparam('book_ids', expanding=True)
+        queries = []
+        for facet, link_column in (('authors', 'author'), ('tags', 'tag'),
+                ('series', 'series')):
+            attributes = self._tables[facet]
+            link = self._tables['books_%s_link' % facet]
+            queries.append(select(link.c.book, literal(facet), attributes.c.name)
+                .join_from(link, attributes, getattr(link.c, link_column) == attributes.c.id)
+                .where(link.c.book.in_(book_ids)))
+        queries.append(select(self._tables['Data'].c.book, literal('formats'),
+                    self._tables['Data'].c.format)
+                .where(self._tables['Data'].c.book.in_(book_ids)))
+        return union_all(*queries)
+
+    def _build_search_documents_query(self):
+        authors = select(group_concat(self._tables['authors'].c.name, ' & '))\
+                .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
+                    self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
+                .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
+                .label('authors')
+        series = select(self._tables['series'].c.name)\
+                .select_from(self._tables['series'].join(self._tables['books_series_link'],
+                    self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
+                .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
+                .label('series')
+        tags = select(group_concat(self._tables['tags'].c.name, ', '))\
+                .select_from(self._tables['tags'].join(self._tables['books_tags_link'],
+                    self._tables['books_tags_link'].c.tag == self._tables['tags'].c.id))\
+                .where(self._tables['books_tags_link'].c.book == self._tables['books'].c.id)\
+                .label('tags')
+        comment = select(self._tables['comments'].c.text)\
+                .where(self._tables['comments'].c.book == self._tables['books'].c.id)\
+                .label('comments')
+        return select(self._tables['books'].c.id, self._tables['books'].c.title,
+                      authors, series, tags, comment)\
+                .where(self._tables['books'].c.id.in_(bindparam('book_ids', expanding=True)))
 
     @staticmethod
     def resultproxy_to_dict(result):
@@ -434,89 +1038,209 @@ class CalibreDBW:
         CalibreDBW._CALIBRE_VERSION = m.group(1)
         return CalibreDBW._CALIBRE_VERSION
 
-    def list_books_attributes(self, attr_table, attr_link_column, limit=0, page=0):
+    def list_books_attributes(self, attr_table, attr_link_column, limit=0, page=0,
+            prefix=None):
+        """Names of the attr_table entries used by at least one book, in name
+        order, with their book counts. prefix keeps the names starting with
+        it, ignoring case."""
+        return self._cache.get(('attributes', attr_table, limit, page, prefix),
+            lambda: self._list_books_attributes(attr_table, attr_link_column,
+                limit, page, prefix))
+
+    def count_books_attributes(self, attr_table, attr_link_column, prefix=None):
+        """How many entries list_books_attributes() has in total."""
+        return self._cache.get(('attributes_count', attr_table, prefix),
+            lambda: self._query_attributes(attr_table, attr_link_column, prefix,
+                count=True)[0].total)
+
+    @staticmethod
+    def _prefix_params(prefix):
+        if prefix is None:
+            return {}
+        # a range rather than LIKE so the NOCASE name index serves it
+        return {'prefix': prefix, 'prefix_end': prefix + '\U0010ffff'}
+
+    def _list_books_attributes(self, attr_table, attr_link_column, limit, page, prefix):
+        if limit > 0 and page > 0:
+            rows = self._query_attributes(attr_table, attr_link_column, prefix,
+                    paged=True, limit=limit, offset=(page - 1) * limit)
+        else:
+            rows = self._query_attributes(attr_table, attr_link_column, prefix)
+        return [{'name': row.name, 'count': row.book_count} for row in rows]
+
+    def _query_attributes(self, attr_table, attr_link_column, prefix, paged=False,
+            count=False, **params):
+        # the counts kept with the search index are read when it is there,
+        # the library link tables are only counted without it
+        prefixed = prefix is not None
+        params.update(self._prefix_params(prefix))
+        if self.refresh_search_index():
+            return self._execute(('facet_counts', prefixed, paged, count),
+                lambda: self._build_facet_counts_query(prefixed, paged, count),
+                facet=attr_table, **params)
+        return self._execute(('attributes', attr_table, prefixed, paged, count),
+            lambda: self._build_attributes_query(attr_table, attr_link_column,
+                prefixed, paged, count),
+            **params)
+
+    @staticmethod
+    def _build_facet_counts_query(prefixed, paged=False, count=False):
+        if count:
+            stm = select(func.count().label('total')).select_from(FACET_COUNTS)
+        else:
+            stm = select(FACET_COUNTS.c.name, FACET_COUNTS.c.count.label('book_count'))\
+                .order_by(FACET_COUNTS.c.name)
+        stm = stm.where(FACET_COUNTS.c.facet == bindparam('facet'))
+        if prefixed:
+            stm = stm.where(FACET_COUNTS.c.name >= bindparam('prefix'))\
+                .where(FACET_COUNTS.c.name < bindparam('prefix_end'))
+        if paged:
+            stm = stm.limit(bindparam('limit')).offset(bindparam('offset'))
+        return stm
+
+    def _build_attributes_query(self, attr_table, attr_link_column, prefixed,
+            paged=False, count=False):
         a_table = self._tables[attr_table]
         books_attr_link = self._tables['books_%s_link' % attr_table]
         link_col = getattr(books_attr_link.c, attr_link_column)
 
-        with self._session() as session:
-            stm = select(a_table.c.name, func.count(books_attr_link.c.id).label('book_count'))\
-                .join(books_attr_link, link_col == a_table.c.id)\
-                .group_by(a_table.c.id)\
+        # walk the attributes in name order and count each one's books through
+        # the link index, so a page only touches the rows it returns
+        book_count = select(func.count(books_attr_link.c.id))\
+            .where(link_col == a_table.c.id)\
+            .scalar_subquery()
+        used = select(books_attr_link.c.id)\
+            .where(link_col == a_table.c.id)\
+            .exists()
+        if count:
+            stm = select(func.count().label('total')).select_from(a_table)
+        else:
+            stm = select(a_table.c.name, book_count.label('book_count'))\
                 .order_by(a_table.c.name)
+        stm = stm.where(used)
 
-            if limit > 0 and page > 0:
-                stm = stm.limit(limit).offset((page - 1) * limit)
+        if prefixed:
+            stm = stm.where(a_table.c.name >= bindparam('prefix'))\
+                .where(a_table.c.name < bindparam('prefix_end'))
+        if paged:
+            stm = stm.limit(bindparam('limit')).offset(bindparam('offset'))
+        return stm
 
-            return [{'name': row.name, 'count': row.book_count}
-                    for row in session.execute(stm).fetchall()]
+    def list_tags(self, limit=0, page=0, prefix=None):
+        return self.list_books_attributes('tags', 'tag', limit, page, prefix)
 
-    def list_tags(self, limit=0, page=0):
-        return self.list_books_attributes('tags', 'tag', limit, page)
+    def list_series(self, limit=0, page=0, prefix=None):
+        return self.list_books_attributes('series', 'series', limit, page, prefix)
 
-    def list_series(self, limit=0, page=0):
-        return self.list_books_attributes('series', 'series', limit, page)
+    def list_authors(self, limit=0, page=0, prefix=None):
+        return self.list_books_attributes('authors', 'author', limit, page, prefix)
 
-    def list_authors(self, limit=0, page=0):
-        return self.list_books_attributes('authors', 'author', limit, page)
+    def count_tags(self, prefix=None):
+        return self.count_books_attributes('tags', 'tag', prefix)
+
+    def count_series(self, prefix=None):
+        return self.count_books_attributes('series', 'series', prefix)
+
+    def count_authors(self, prefix=None):
+        return self.count_books_attributes('authors', 'author', prefix)
 
     def get_book_cover_info(self, book_id):
-        with self._session() as session:
-            authors = select(group_concat(self._tables['authors'].c.name, ';'))\
-                    .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
-                        self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
-                    .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
-                    .label('authors')
-            stm = select(self._tables['books'].c.has_cover,
-                         self._tables['books'].c.path,
-                         self._tables['books'].c.title,
-                         authors)\
-                    .where(self._tables['books'].c.id == book_id)
-            return session.execute(stm).first()
+        return self.get_book(book_id)
 
     def get_book(self, book_id):
-        with self._session() as session:
-            author = select(group_concat(self._tables['authors'].c.name, ';'))\
-                    .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
-                        self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
-                    .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
-                    .label('authors')
-            series = select(self._tables['series'].c.name)\
-                    .select_from(self._tables['series'].join(self._tables['books_series_link'],
-                        self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
-                    .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
-                    .label('series')
-            comment = select(self._tables['comments'].c.text)\
-                    .where(self._tables['comments'].c.book == book_id).label('comments')
-            isbn = select(self._tables['identifiers'].c.val)\
-                    .where(and_(self._tables['identifiers'].c.book == book_id,
-                        self._tables['identifiers'].c.type == 'isbn')).label('isbn')
-            tags = select(group_concat(self._tables['tags'].c.name, ', '))\
-                    .select_from(self._tables['tags'].join(self._tables['books_tags_link'],
-                        self._tables['books_tags_link'].c.tag == self._tables['tags'].c.id))\
-                    .where(self._tables['books_tags_link'].c.book == self._tables['books'].c.id)\
-                    .label('tags')
-            publisher = select(group_concat(self._tables['publishers'].c.name, ', '))\
-                    .select_from(self._tables['publishers'].join(self._tables['books_publishers_link'],
-                        self._tables['books_publishers_link'].c.publisher == self._tables['publishers'].c.id))\
-                    .where(self._tables['books_publishers_link'].c.book == self._tables['books'].c.id)\
-                    .label('publisher')
-            languages = select(group_concat(self._tables['languages'].c.lang_code, ', '))\
-                    .select_from(self._tables['languages'].join(self._tables['books_languages_link'],
-                        self._tables['books_languages_link'].c.lang_code == self._tables['languages'].c.id))\
-                    .where(self._tables['books_languages_link'].c.book == self._tables['books'].c.id)\
-                    .label('languages')
-            rating = select(self._tables['ratings'].c.rating)\
-                    .select_from(self._tables['ratings'].join(self._tables['books_ratings_link'],
-                        self._tables['books_ratings_link'].c.rating == self._tables['ratings'].c.id))\
-                    .where(self._tables['books_ratings_link'].c.book == self._tables['books'].c.id)\
-                    .label('rating')
-
-            stm = select(self._tables['books'].c.title, self._tables['books'].c.path, self._tables['books'].c.pubdate,
-                        self._tables['books'].c.has_cover, self._tables['books'].c.id, self._tables['books'].c.series_index,
-                        author, comment, isbn, series, tags, publisher, languages, rating)\
-                    .where(self._tables['books'].c.id == book_id)
-            return session.execute(stm).first()
+        return self.get_books([book_id]).get(book_id)
+
+    def get_books(self, book_ids):
+        """Full records of the given books, keyed by id.
+
+        A record holds the book columns, its authors (';' separated), series,
+        tags, publisher, languages, rating, comments and isbn, its page count
+        and the list of its formats with their file names. Missing books are
+        loaded in a single query, so a whole page of results costs one round
+        trip."""
+        found = self._cache.get_many([('book', book_id) for book_id in book_ids],
+                lambda keys: {('book', book['id']): book
+                    for book in self._load_books([key[1] for key in keys])})
+        return {key[1]: book for key, book in found.items()}
+
+    def _load_books(self, book_ids):
+        books = []
+        for i in range(0, len(book_ids), LOAD_CHUNK_SIZE):
+            books += self._load_books_chunk(book_ids[i:i + LOAD_CHUNK_SIZE])
+        return books
+
+    def _load_books_chunk(self, book_ids):
+        books = self.resultproxy_to_dict(self._execute(('load_books',),
+            self._build_load_books_query, book_ids=book_ids))
+        for book in books:
+            book['formats'] = [{'format': book_format['format'],
+                    'size': '%.2f' % (book_format['size'] / (1024*1024)),
+                    'name': book_format['name']}
+                for book_format in json.loads(book['formats'])]
+        return books
+
+    def _build_load_books_query(self):
+        author = select(group_concat(self._tables['authors'].c.name, ';'))\
+                .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
+                    self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
+                .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
+                .label('authors')
+        series = select(self._tables['series'].c.name)\
+                .select_from(self._tables['series'].join(self._tables['books_series_link'],
+                    self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
+                .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
+                .label('series')
+        comment = select(self._tables['comments'].c.text)\
+                .where(self._tables['comments'].c.book == self._tables['books'].c.id)\
+                .label('comments')
+        isbn = select(self._tables['identifiers'].c.val)\
+                .where(and_(self._tables['identifiers'].c.book == self._tables['books'].c.id,
+                    self._tables['identifiers'].c.type == 'isbn')).label('isbn')
+        tags = select(group_concat(self._tables['tags'].c.name, ', '))\
+                .select_from(self._tables['tags'].join(self._tables['books_tags_link'],
+                    self._tables['books_tags_link'].c.tag == self._tables['tags'].c.id))\
+                .where(self._tables['books_tags_link'].c.book == self._tables['books'].c.id)\
+                .label('tags')
+        publisher = select(group_concat(self._tables['publishers'].c.name, ', '))\
+                .select_from(self._tables['publishers'].join(self._tables['books_publishers_link'],
+                    self._tables['books_publishers_link'].c.publisher == self._tables['publishers'].c.id))\
+                .where(self._tables['books_publishers_link'].c.book == self._tables['books'].c.id)\
+                .label('publisher')
+        languages = select(group_concat(self._tables['languages'].c.lang_code, ', '))\
+                .select_from(self._tables['languages'].join(self._tables['books_languages_link'],
+                    self._tables['books_languages_link'].c.lang_code == self._tables['languages'].c.id))\
+                .where(self._tables['books_languages_link'].c.book == self._tables['books'].c.id)\
+                .label('languages')
+        rating = select(self._tables['ratings'].c.rating)\
+                .select_from(self._tables['ratings'].join(self._tables['books_ratings_link'],
+                    self._tables['books_ratings_link'].c.rating == self._tables['ratings'].c.id))\
+                .where(self._tables['books_ratings_link'].c.book == self._tables['books'].c.id)\
+                .label('rating')
+        formats = select(func.json_group_array(func.json_object(
+                    'format', self._tables['Data'].c.format,
+                    'size', self._tables['Data'].c.uncompressed_size,
+                    'name', self._tables['Data'].c.name)))\
+                .where(self._tables['Data'].c.book == self._tables['books'].c.id)\
+                .label('formats')
+        if 'pages_custom' in self._tables:
+            page_count = select(self._tables['pages_custom'].c.value)\
+                    .where(self._tables['pages_custom'].c.book == self._tables['books'].c.id)\
+                    .label('page_count')
+        else:
+            page_count = null().label('page_count')
+
+        return select(self._tables['books'].c.title, self._tables['books'].c.path, self._tables['books'].c.pubdate,
+                    self._tables['books'].c.has_cover, self._tables['books'].c.id, self._tables['books'].c.series_index,
+                    author, comment, isbn, series, tags, publisher, languages, rating,
+                    formats, page_count)\
+                .where(self._tables['books'].c.id.in_(bindparam('book_ids', expanding=True)))
+
+    def format_location(self, book, book_format):
+        """(directory, file name) of a format of a get_books() record."""
+        for f in book['formats']:
+            if f['format'].upper() == book_format.upper():
+                return os.path.join(self._calibre_lib_dir, book['path']), \
+                        '%s.%s' % (f['name'], book_format.lower())
 
     def get_book_attributes(self, book_id, attribute_table_name,
                             attribute_column_name,
@@ -557,8 +1281,9 @@ class CalibreDBW:
                 'lang_code')
 
     def get_book_details(self, book_id):
-        book, formats = self.resultproxy_to_dict(self.get_book(book_id)), None
+        book, formats = self.get_book(book_id), None
         if book:
+            book = dict(book)
             book['authors'] = ' & '.join(book['authors'].split(';')) if book['authors'] else ''
             book['series'] = ' & '.join(book['series'].split(';')) if book['series'] else ''
             # calibredb refuses to set series_index on a book without a series,
@@ -567,41 +1292,15 @@ class CalibreDBW:
                 book['series_index'] = 1.0
             book['rating'] = int(book['rating'] / 2) if book['rating'] else book['rating']
             book['read'] = any(t.strip() == 'read' for t in (book['tags'] or '').split(','))
-            formats = self.get_book_formats(book_id)
-        return (book, formats)
+            formats = [{'format': f['format'], 'size': f['size']}
+                    for f in book.pop('formats')]
+        return (book or {}, formats)
 
     def get_book_formats(self, book_id):
-        formats = []
-        with self._session() as session:
-            stm = select(self._tables['Data']).where(self._tables['Data'].c.book == book_id)
-            for book_format in session.execute(stm).fetchall():
-                formats.append({'format': book_format.format,
-                    'size': '%.2f' % (
-                        book_format.uncompressed_size / (1024*1024))})
-            return formats
-
-    def get_book_title(self, book_id):
-        with self._session() as session:
-            stm = select(self._tables['books'].c.title).where(self._tables['books'].c.id == book_id)
-            return session.execute(stm).first().title
-
-    def get_book_title_info(self, book_id):
-        with self._session() as session:
-            authors = select(group_concat(self._tables['authors'].c.name, ' & '))\
-                    .select_from(self._tables['authors'].join(self._tables['books_authors_link'],
-                        self._tables['books_authors_link'].c.author == self._tables['authors'].c.id))\
-                    .where(self._tables['books_authors_link'].c.book == self._tables['books'].c.id)\
-                    .label('authors')
-            series = select(self._tables['series'].c.name)\
-                    .select_from(self._tables['series'].join(self._tables['books_series_link'],
-                        self._tables['books_series_link'].c.series == self._tables['series'].c.id))\
-                    .where(self._tables['books_series_link'].c.book == self._tables['books'].c.id)\
-                    .label('series')
-            stm = select(self._tables['books'].c.title,
-                         self._tables['books'].c.series_index,
-                         series, authors)\
-                    .where(self._tables['books'].c.id == book_id)
-            return session.execute(stm).first()
+        book = self.get_book(book_id)
+        if not book:
+            return []
+        return [{'format': f['format'], 'size': f['size']} for f in book['formats']]
 
     def write_format_title(self, file_path, title):
         res = subprocess.run(['ebook-meta', file_path, '--title', title],
@@ -610,34 +1309,56 @@ class CalibreDBW:
             err = 'error retitling %s: %s' % (file_path, res.stderr.decode())
             print(err, flush=True)
             raise RuntimeError(err)
+        # ebook-meta tells the format by the file extension, and succeeds
+        # leaving a file it does not know as it was: the metadata it read
+        # back last must have the new title
+        titles = RE_EBOOK_META_TITLE.findall(res.stdout.decode(errors='replace'))
+        if not titles or titles[-1].strip() != title.strip():
+            err = 'ebook-meta did not retitle %s' % file_path
+            print(err, flush=True)
+            raise RuntimeError(err)
 
     def get_book_file(self, book_id, book_format):
-        with self._session() as session:
-            stm = select(self._tables['Data'].c.name, self._tables['books'].c.path)\
-                    .join(self._tables['books'], self._tables['books'].c.id == self._tables['Data'].c.book)\
-                    .where(self._tables['Data'].c.book == book_id)\
-                    .where(self._tables['Data'].c.format == book_format)
-            row = session.execute(stm).first()
-            if row:
-                return os.path.join(self._calibre_lib_dir, row.path), '%s.%s' % (row.name, book_format.lower())
+        book = self.get_book(book_id)
+        if book:
+            return self.format_location(book, book_format)
 
     def list_all_book_ids(self):
         with self._session() as session:
             stm = select(self._tables['books'].c.id)
             return [row.id for row in session.execute(stm).fetchall()]
 
-    def get_page_count(self, book_id):
-        if not self._pages_column_id or 'pages_custom' not in self._tables:
-            return None
-        with self._session() as session:
-            t = self._tables['pages_custom']
-            stm = select(t.c.value).where(t.c.book == book_id)
-            row = session.execute(stm).first()
-            return row.value if row else None
-
     def set_page_count(self, book_id, count):
         if not self._pages_column_id:
             return
         self._run_calibredb(['set_custom',
             '--library-path', self._calibre_lib_dir,
             'pages', str(book_id), str(int(count))])
+
+    def set_page_counts(self, counts):
+        """Writes {book_id: count} to the #pages column in one transaction.
+
+        A calibredb set_custom per book costs a command each, too many for a
+        whole library scan: the column table is written directly instead,
+        under the same lock as calibredb, and the books are marked dirty for
+        calibre to rewrite their metadata.opf backups as set_custom would."""
+        if not self._pages_column_id or not counts:
+            return
+        rows = [(book_id, int(count)) for book_id, count in counts.items()]
+        with self._library_write_lock():
+            con = connect_writable(self._calibre_db,
+                    int(self._config.get('LIBRARY_SQLITE_BUSY_TIMEOUT', 5000)) / 1000)
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                con.executemany('INSERT INTO custom_column_%d (book, value) VALUES (?, ?) '
+                        'ON CONFLICT (book) DO UPDATE SET value = excluded.value'
+                        % self._pages_column_id, rows)
+                con.executemany('INSERT OR IGNORE INTO metadata_dirtied (book) VALUES (?)',
+                        [(book_id,) for book_id, _ in rows])
+                con.execute('COMMIT')
+            except Exception:
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                raise
+            finally:
+                con.close()
@@ -0,0 +1,210 @@
+"""Long-lived calibredb process.
+
+Run as a script under calibre's interpreter (calibre-debug -e), it reads
+calibredb command lines from stdin and runs them in order, in process,
+keeping each library open between commands. The protocol is one JSON object
+per line:
+
+    worker, on start:   {"ready": true, "protocol": 1}
+    request:            {"args": ["add", "-d", "/tmp/book.epub", "--library-path", "/books"]}
+    response:           {"returncode": 0, "stdout": "...", "stderr": "..."}
+
+Anything speaking it can stand in for calibre, tests included. The worker
+exits on end of input, or after idling for CALIBREDB_WORKER_IDLE_TIMEOUT
+seconds, taken from its environment.
+"""
+import json
+import os
+import select
+import shlex
+import subprocess
+import sys
+import time
+
+PROTOCOL_VERSION = 1
+WORKER_SCRIPT = os.path.abspath(__file__)
+# how long a worker that failed to start is left alone
+RESPAWN_DELAY = 60
+# a worker this close to its idle timeout may exit under our feet, it is
+# replaced rather than sent a command
+IDLE_MARGIN = 5
+
+
+class WorkerUnavailable(Exception):
+    """The command could not be handed to the worker, and did not run."""
+
+
+class CalibredbWorker:
+    """Client end of a calibredb worker, started on first use and restarted
+    when it exits. Not thread-safe: callers hold the calibredb lock."""
+
+    def __init__(self, command=None, idle_timeout=300, timeout=3600):
+        self._command = shlex.split(command) if command else \
+                ['calibre-debug', '-e', WORKER_SCRIPT]
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._process = None
+        self._retry_at = 0
+        self._last_used = 0
+
+    def _start(self):
+        if time.monotonic() < self._retry_at:
+            raise WorkerUnavailable('worker failed to start recently')
+        try:
+            self._process = subprocess.Popen(self._command,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=None, text=True, encoding='utf-8', bufsize=1,
+                    env=dict(os.environ,
+                        CALIBREDB_WORKER_IDLE_TIMEOUT=str(self._idle_timeout)))
+            hello = self._read(60)
+            if not hello.get('ready') or hello.get('protocol') != PROTOCOL_VERSION:
+                raise RuntimeError('unexpected handshake %s' % hello)
+        except Exception as e:
+            self.close()
+            self._retry_at = time.monotonic() + RESPAWN_DELAY
+            raise WorkerUnavailable('could not start calibredb worker: %s' % e)
+
+    def _read(self, timeout):
+        ready, _, _ = select.select([self._process.stdout], [], [], timeout)
+        if not ready:
+            raise RuntimeError('calibredb worker timed out')
+        line = self._process.stdout.readline()
+        if not line:
+            raise RuntimeError('calibredb worker exited')
+        return json.loads(line)
+
+    def _send(self, args):
+        if self._process is not None and (self._process.poll() is not None
+                or time.monotonic() - self._last_used > self._idle_timeout - IDLE_MARGIN):
+            self.close()
+        if self._process is None:
+            self._start()
+        self._process.stdin.write(json.dumps({'args': args}) + '\n')
+        self._process.stdin.flush()
+
+    def run(self, args):
+        """Runs calibredb args in the worker, as subprocess.run would with
+        capture_output. Raises WorkerUnavailable when the command was not
+        delivered, RuntimeError when the worker died running it."""
+        try:
+            self._send(args)
+        except (BrokenPipeError, OSError):
+            # it exited since the last command, once more with a fresh one
+            self.close()
+            try:
+                self._send(args)
+            except (BrokenPipeError, OSError) as e:
+                self.close()
+                raise WorkerUnavailable('calibredb worker unreachable: %s' % e)
+        try:
+            res = self._read(self._timeout)
+        except Exception:
+            # the command may or may not have run, it must not be retried
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+        return subprocess.CompletedProcess(['calibredb'] + args,
+                res['returncode'], res['stdout'].encode(), res['stderr'].encode())
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._process.wait(5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+
+def library_signature(library_path):
+    signature = []
+    for name in ('metadata.db', 'metadata.db-wal'):
+        try:
+            st = os.stat(os.path.join(library_path, name))
+            signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return signature
+
+
+def calibre_runner():
+    import io
+    import traceback
+    from contextlib import redirect_stdout, redirect_stderr
+    from calibre.db.cli import main as cli
+
+    # each command used to open its library; keep it open instead, unless
+    # someone else wrote to it since this worker last did, as the library
+    # object caches its metadata in memory
+    libraries = {}
+    open_db = getattr(cli.DBCtx, 'db', None)
+    if isinstance(open_db, property):
+        def db(ctx):
+            if getattr(ctx, '_db', None) is None:
+                path = os.path.abspath(ctx.library_path)
+                cached = libraries.get(path)
+                if cached is None or cached[1] != library_signature(path):
+                    if cached is not None:
+                        cached[0].close()
+                    cached = libraries[path] = [open_db.fget(ctx), None]
+                ctx._db = cached[0]
+            return ctx._db
+        cli.DBCtx.db = property(db)
+
+    def run(args):
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        stderr = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                returncode = cli.main(['calibredb'] + args) or 0
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+        for path, cached in libraries.items():
+            cached[1] = library_signature(path)
+        output = []
+        for stream in (stdout, stderr):
+            stream.flush()
+            output.append(stream.buffer.getvalue().decode('utf-8', 'replace'))
+        return {'returncode': returncode, 'stdout': output[0], 'stderr': output[1]}
+
+    return run
+
+
+def serve(run, idle_timeout):
+    # whatever calibre prints to the standard output must not mix with the
+    # protocol: keep it for ourselves and send fd 1 to stderr
+    protocol = os.fdopen(os.dup(1), 'w', encoding='utf-8', buffering=1)
+    os.dup2(2, 1)
+    requests = sys.stdin
+
+    def reply(message):
+        protocol.write(json.dumps(message) + '\n')
+        protocol.flush()
+
+    reply({'ready': True, 'protocol': PROTOCOL_VERSION})
+    while True:
+        ready, _, _ = select.select([requests], [], [], idle_timeout)
+        if not ready:
+            break
+        line = requests.readline()
+        if not line:
+            break
+        try:
+            args = json.loads(line)['args']
+        except (ValueError, KeyError, TypeError) as e:
+            reply({'returncode': 2, 'stdout': '', 'stderr': 'bad request: %s' % e})
+            continue
+        reply(run(args))
+
+
+if __name__ == '__main__':
+    idle_timeout = os.environ.get('CALIBREDB_WORKER_IDLE_TIMEOUT')
+    serve(calibre_runner(), float(idle_timeout) if idle_timeout else None)
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import shutil
+from threading import Lock
+from .disk_cache import DiskCache
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ConversionCache(DiskCache):
+    """Converted files, named after a hash of what they were converted from
+    and how: the source file's content, the target format, calibre's version
+    and the conversion options.
+
+    A conversion of a key being converted, by any process, waits for it and
+    uses its result instead of converting again."""
+
+    def __init__(self, directory, max_size):
+        super().__init__(directory, max_size)
+        self._digests = {}
+        self._digests_lock = Lock()
+
+    def source_digest(self, path):
+        st = os.stat(path)
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._digests_lock:
+            cached = self._digests.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        with self._digests_lock:
+            if len(self._digests) > 1024:
+                self._digests.clear()
+            self._digests[path] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+    def key(self, source_path, format_to, calibre_version, options):
+        return hashlib.sha256(json.dumps([self.source_digest(source_path),
+            format_to.upper(), calibre_version, list(options)]).encode()).hexdigest()
+
+    def convert(self, key, format_to, dest, convert):
+        """Puts the conversion of key at dest, running convert(path) to make
+        it when not stored yet. Returns whether it was stored."""
+        _, hit = self.fetch(key, format_to, convert,
+                lambda path: _link_or_copy(path, dest))
+        if not hit:
+            self.evict()
+        return hit
+
+
+def _link_or_copy(path, dest):
+    try:
+        os.link(path, dest)
+    except OSError:
+        shutil.copyfile(path, dest)
@@ -0,0 +1,181 @@
+import fcntl
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+# keys share lock files by their first characters, so that there are never
+# more than a few hundred of them
+LOCK_PREFIX_LENGTH = 2
+
+
+class DiskCache:
+    """Files made once and kept in a directory, up to max_size bytes, the
+    least recently used dropped first. Uses are told by the access time,
+    leaving the modification time of a file, which web servers derive their
+    validators from, as it was made.
+
+    Making a key that is being made, by any process, waits for it and uses
+    its result instead. Keys are made of characters safe in a file name."""
+
+    def __init__(self, directory, max_size):
+        self._dir = directory
+        self._max_size = max_size
+        self._janitor_pid = None
+        self._janitor_lock = Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def _path(self, key, ext):
+        return os.path.join(self._dir, '%s.%s' % (key, ext.lower()))
+
+    @contextmanager
+    def _key_lock(self, key, blocking=True):
+        with open(os.path.join(self._dir, '%s.lock' % key[:LOCK_PREFIX_LENGTH]),
+                'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def lookup(self, key, ext):
+        """Path of the file of key if kept, else None."""
+        path = self._path(key, ext)
+        with self._key_lock(key):
+            try:
+                _touch(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    @contextmanager
+    def _make_lock(self, key, blocking=True):
+        # a lock file of its own, removed by its holder, so that keys sharing
+        # a prefix are not held up while one is made
+        path = os.path.join(self._dir, '%s.make.lock' % key)
+        while True:
+            with open(path, 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    # removed by a holder while waiting for it
+                    if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                try:
+                    yield True
+                finally:
+                    _remove(path)
+                return
+
+    def _use(self, path, then):
+        with self._key_lock(os.path.basename(path)):
+            if not os.path.exists(path):
+                return False
+            _touch(path)
+            if then is not None:
+                then(path)
+        return True
+
+    def fetch(self, key, ext, make, then=None):
+        """Path of the file of key, running make(path) to make it when not
+        kept yet, and then then(path) while it cannot be evicted. Returns
+        (path, whether it was kept)."""
+        path = self._path(key, ext)
+        if self._use(path, then):
+            return path, True
+        with self._make_lock(key):
+            if self._use(path, then):
+                return path, True
+            # ending in ext, which tools like ebook-convert go by
+            tmp_path = self._path('%s.%s.tmp' % (key, uuid.uuid4().hex[:8]), ext)
+            try:
+                make(tmp_path)
+                with self._key_lock(key):
+                    os.replace(tmp_path, path)
+                    if then is not None:
+                        then(path)
+            finally:
+                _remove(tmp_path)
+        return path, False
+
+    def evict(self):
+        entries = []
+        size = 0
+        for entry in os.scandir(self._dir):
+            if entry.name.endswith('.make.lock'):
+                # left by a process that died making it
+                with self._make_lock(entry.name[:-len('.make.lock')],
+                        blocking=False):
+                    pass
+                continue
+            if entry.name.endswith('.lock'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if '.tmp.' in entry.name:
+                # left by a process that died making it
+                if st.st_mtime < time.time() - 86400:
+                    _remove(entry.path)
+                continue
+            entries.append((st.st_atime, st.st_size, entry.path))
+            size += st.st_size
+        entries.sort()
+        for atime, entry_size, path in entries:
+            if size <= self._max_size:
+                break
+            # entries in use are skipped, and so are those used meanwhile
+            with self._key_lock(os.path.basename(path), blocking=False) as locked:
+                try:
+                    if not locked or os.path.getatime(path) > atime:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+            size -= entry_size
+
+    def start_janitor(self, interval):
+        """Evicts every interval seconds from a thread of the current
+        process, started once per process: call it on each use, as a forked
+        process does not have its parent's threads."""
+        if not self.enabled or self._janitor_pid == os.getpid():
+            return
+        with self._janitor_lock:
+            if self._janitor_pid == os.getpid():
+                return
+            self._janitor_pid = os.getpid()
+            Thread(target=self._janitor, args=(interval,), daemon=True,
+                    name='cache-janitor').start()
+
+    def _janitor(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict()
+            except Exception as e:
+                print('cache eviction in %s failed: %s' % (self._dir, e), flush=True)
+
+
+def _touch(path):
+    # marks it recently used
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
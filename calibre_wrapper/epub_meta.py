@@ -0,0 +1,237 @@
+"""Title rewrite of EPUB files, in process.
+
+The output is the source zip with every member copied byte for byte, still
+compressed, but the OPF package document, whose dc:title is replaced. Its
+size is known before anything is written, and it is read in chunks: a
+download starts at once and never needs the whole book in memory, nor a
+temporary copy.
+
+Anything unusual (zip64, encryption, no dc:title) raises EpubRewriteError,
+for the caller to fall back to calibre's ebook-meta."""
+import re
+import struct
+import zlib
+from xml.sax.saxutils import escape
+
+CHUNK_SIZE = 64 * 1024
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_SIGNATURE = 0x06054b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+# flags: encrypted, sizes in a data descriptor
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+STORED = 0
+DEFLATED = 8
+
+RE_ROOTFILE = re.compile(rb'<(?:\w+:)?rootfile\b[^>]*?\bfull-path\s*=\s*["\']([^"\']+)["\']')
+RE_TITLE = re.compile(r'(<dc:title\b[^>]*>)(.*?)(</dc:title\s*>)', re.S)
+
+
+class EpubRewriteError(Exception):
+    pass
+
+
+class _Member:
+    def __init__(self, central, name, extra, comment):
+        (_, self.version_made, self.version_needed, self.flags, self.method,
+            self.mtime, self.mdate, self.crc, self.compress_size, self.file_size,
+            _, _, _, self.disk, self.internal_attr, self.external_attr,
+            self.offset) = central
+        self.name = name
+        self.extra = extra
+        self.comment = comment
+
+
+def _read_members(f):
+    f.seek(0, 2)
+    file_size = f.tell()
+    # the end record is the last thing in the file, before a comment of up
+    # to 64 KiB
+    tail_size = min(file_size, END_RECORD.size + 0xffff)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    pos = tail.rfind(struct.pack('<I', END_RECORD_SIGNATURE))
+    if pos < 0:
+        raise EpubRewriteError('not a zip file')
+    (_, disk, cd_disk, _, count, cd_size, cd_offset, comment_size) = \
+            END_RECORD.unpack_from(tail, pos)
+    if disk or cd_disk or count == 0xffff or 0xffffffff in (cd_size, cd_offset):
+        raise EpubRewriteError('multi-disk or zip64 archive')
+    archive_comment = tail[pos + END_RECORD.size:pos + END_RECORD.size + comment_size]
+    f.seek(cd_offset)
+    directory = f.read(cd_size)
+    members = []
+    pos = 0
+    for _ in range(count):
+        central = CENTRAL_HEADER.unpack_from(directory, pos)
+        if central[0] != CENTRAL_HEADER_SIGNATURE:
+            raise EpubRewriteError('bad central directory')
+        name_size, extra_size, comment_size = central[10:13]
+        pos += CENTRAL_HEADER.size
+        name = directory[pos:pos + name_size]
+        extra = directory[pos + name_size:pos + name_size + extra_size]
+        comment = directory[pos + name_size + extra_size:
+                pos + name_size + extra_size + comment_size]
+        pos += name_size + extra_size + comment_size
+        member = _Member(central, name, extra, comment)
+        if member.flags & FLAG_ENCRYPTED:
+            raise EpubRewriteError('encrypted member %r' % name)
+        if 0xffffffff in (member.compress_size, member.file_size, member.offset):
+            raise EpubRewriteError('zip64 member %r' % name)
+        members.append(member)
+    members.sort(key=lambda member: member.offset)
+    return members, archive_comment
+
+
+def _local_length(f, member):
+    """Length of a member's local header, data and data descriptor."""
+    f.seek(member.offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise EpubRewriteError('bad local header for %r' % member.name)
+    length = LOCAL_HEADER.size + header[9] + header[10] + member.compress_size
+    if member.flags & FLAG_DATA_DESCRIPTOR:
+        f.seek(member.offset + length)
+        signature = f.read(4)
+        length += 16 if signature == struct.pack('<I', DATA_DESCRIPTOR_SIGNATURE) else 12
+    return length
+
+
+def _read_member(f, member):
+    f.seek(member.offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    f.seek(member.offset + LOCAL_HEADER.size + header[9] + header[10])
+    data = f.read(member.compress_size)
+    if member.method == DEFLATED:
+        return zlib.decompress(data, -15)
+    if member.method == STORED:
+        return data
+    raise EpubRewriteError('unsupported compression for %r' % member.name)
+
+
+def _patch_title(opf, title):
+    encoding = 'utf-8'
+    m = re.match(rb'<\?xml[^>]*encoding\s*=\s*["\']([\w.-]+)', opf)
+    if m:
+        encoding = m.group(1).decode('ascii')
+    try:
+        text = opf.decode(encoding)
+    except (LookupError, UnicodeDecodeError) as e:
+        raise EpubRewriteError('undecodable package document: %s' % e)
+    text, count = RE_TITLE.subn(lambda m: m.group(1) + escape(title) + m.group(3),
+            text, count=1)
+    if not count:
+        raise EpubRewriteError('no dc:title in the package document')
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
+class RetitledEpub:
+    """Raw file-like reading of an EPUB with its title replaced. size is
+    the length of what read() returns until exhausted."""
+
+    def __init__(self, path, title):
+        self._f = open(path, 'rb')
+        try:
+            self._plan(title)
+        except Exception:
+            self._f.close()
+            raise
+        self.size = sum(length if data is None else len(data)
+                for data, _, length in self._segments)
+        self._segment = 0
+        self._segment_pos = 0
+
+    def _plan(self, title):
+        f = self._f
+        members, archive_comment = _read_members(f)
+        by_name = {member.name: member for member in members}
+        container = by_name.get(b'META-INF/container.xml')
+        if container is None:
+            raise EpubRewriteError('no META-INF/container.xml')
+        m = RE_ROOTFILE.search(_read_member(f, container))
+        opf_member = by_name.get(m.group(1)) if m else None
+        if opf_member is None:
+            raise EpubRewriteError('no package document')
+        opf = _patch_title(_read_member(f, opf_member), title)
+
+        # (bytes, None, None) is written as is, (None, offset, length)
+        # copied from the source
+        self._segments = []
+        central = []
+        out_offset = 0
+        for member in members:
+            if member is opf_member:
+                if member.method == DEFLATED:
+                    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+                    data = compressor.compress(opf) + compressor.flush()
+                else:
+                    data = opf
+                flags = member.flags & ~FLAG_DATA_DESCRIPTOR
+                crc = zlib.crc32(opf)
+                header = LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, member.version_needed,
+                        flags, member.method, member.mtime, member.mdate, crc,
+                        len(data), len(opf), len(member.name), 0) + member.name
+                self._segments.append((header + data, None, None))
+                central.append(self._central(member, out_offset, flags=flags, crc=crc,
+                    compress_size=len(data), file_size=len(opf)))
+                out_offset += len(header) + len(data)
+            else:
+                length = _local_length(f, member)
+                self._segments.append((None, member.offset, length))
+                central.append(self._central(member, out_offset))
+                out_offset += length
+        directory = b''.join(central)
+        self._segments.append((directory + END_RECORD.pack(END_RECORD_SIGNATURE,
+                0, 0, len(members), len(members), len(directory), out_offset,
+                len(archive_comment)) + archive_comment, None, None))
+
+    @staticmethod
+    def _central(member, offset, **changes):
+        values = dict(flags=member.flags, crc=member.crc,
+                compress_size=member.compress_size, file_size=member.file_size)
+        values.update(changes)
+        return CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, member.version_made,
+                member.version_needed, values['flags'], member.method, member.mtime,
+                member.mdate, values['crc'], values['compress_size'],
+                values['file_size'], len(member.name), len(member.extra),
+                len(member.comment), member.disk, member.internal_attr,
+                member.external_attr, offset) + member.name + member.extra + member.comment
+
+    def read(self, size=CHUNK_SIZE):
+        while self._segment < len(self._segments):
+            data, offset, length = self._segments[self._segment]
+            if data is None:
+                remaining = length - self._segment_pos
+                self._f.seek(offset + self._segment_pos)
+                chunk = self._f.read(min(size, remaining))
+                if not chunk:
+                    raise EpubRewriteError('source file shrank while read')
+            else:
+                chunk = data[self._segment_pos:self._segment_pos + size]
+            self._segment_pos += len(chunk)
+            if self._segment_pos >= (length if data is None else len(data)):
+                self._segment += 1
+                self._segment_pos = 0
+            if chunk:
+                return chunk
+        return b''
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_retitled_epub(path, title, dest):
+    with RetitledEpub(path, title) as epub, open(dest, 'wb') as out:
+        for chunk in iter(epub.read, b''):
+            out.write(chunk)
@@ -0,0 +1,79 @@
+import os
+import time
+import uuid
+
+# claimed files are moved there, out of sight of the other watchers
+PROCESSING_DIR = '.processing'
+# and those calibredb did not add there
+FAILED_DIR = '.failed'
+
+
+class InboxWatcher:
+    """Imports the files dropped into a directory.
+
+    A file is picked up once its size and mtime held still for a whole poll,
+    so that files still being copied are left alone. Picked up files are
+    moved to a directory of their own under PROCESSING_DIR, which makes
+    several watchers on the same inbox safe, then handed to
+    submit([[path, filename], ...]) batch_size at a time."""
+
+    def __init__(self, directory, extensions, submit, interval=10, batch_size=100):
+        self._dir = directory
+        self._extensions = {ext.upper() for ext in extensions}
+        self._submit = submit
+        self._interval = interval
+        self._batch_size = max(1, batch_size)
+        self._seen = {}
+
+    def _candidates(self):
+        seen = {}
+        ready = []
+        for entry in os.scandir(self._dir):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            ext = entry.name.rsplit('.', 1)[-1].upper() if '.' in entry.name else ''
+            if ext not in self._extensions:
+                continue
+            st = entry.stat()
+            seen[entry.name] = (st.st_size, st.st_mtime_ns)
+            if self._seen.get(entry.name) == seen[entry.name]:
+                ready.append(entry.name)
+        self._seen = seen
+        return sorted(ready)
+
+    def _claim(self, names):
+        batch_dir = os.path.join(self._dir, PROCESSING_DIR, uuid.uuid4().hex)
+        os.makedirs(batch_dir)
+        claimed = []
+        for name in names:
+            try:
+                os.rename(os.path.join(self._dir, name), os.path.join(batch_dir, name))
+            except FileNotFoundError:
+                # taken by another watcher
+                continue
+            claimed.append([os.path.join(batch_dir, name), name])
+        if not claimed:
+            os.rmdir(batch_dir)
+        return claimed
+
+    def poll(self):
+        """Submits the files ready, returns how many."""
+        names = self._candidates()
+        count = 0
+        for i in range(0, len(names), self._batch_size):
+            claimed = self._claim(names[i:i + self._batch_size])
+            if claimed:
+                self._submit(claimed)
+                count += len(claimed)
+        for name in names:
+            self._seen.pop(name, None)
+        return count
+
+    def run(self):
+        os.makedirs(os.path.join(self._dir, PROCESSING_DIR), exist_ok=True)
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print('inbox polling failed: %s' % e, flush=True)
+            time.sleep(self._interval)
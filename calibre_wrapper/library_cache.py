@@ -0,0 +1,118 @@
+import os
+from collections import OrderedDict
+from threading import RLock
+from .library_connection import connect_readonly
+
+
+class LibraryCache:
+    """Bounded LRU cache of library reads.
+
+    Entries are dropped as soon as metadata.db changes, whoever wrote it: the
+    data_version of a connection kept open on the library moves with every
+    commit made from another connection, calibredb and desktop calibre
+    included, and the file stat catches the library being swapped.
+    Cached values are shared between callers and must not be mutated."""
+
+    def __init__(self, db_path, max_entries):
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self._watcher = None
+        self._watcher_ino = None
+        self._signature = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _data_version(self, ino):
+        if self._watcher is None or self._watcher_ino != ino:
+            if self._watcher is not None:
+                self._watcher.close()
+            self._watcher = connect_readonly(self._db_path)
+            self._watcher_ino = ino
+        return self._watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    def signature(self):
+        """Opaque value that changes whenever the library does."""
+        with self._lock:
+            st = os.stat(self._db_path)
+            try:
+                wal = os.stat('%s-wal' % self._db_path)
+                wal = (wal.st_mtime_ns, wal.st_size)
+            except OSError:
+                wal = None
+            return (self._data_version(st.st_ino), st.st_ino, st.st_mtime_ns,
+                    st.st_size, wal)
+
+    def _invalidate_if_changed(self, signature):
+        if signature != self._signature:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._signature = signature
+
+    def get(self, key, loader):
+        signature = self.signature()
+        with self._lock:
+            self._invalidate_if_changed(signature)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = loader()
+        self._store(signature, {key: value})
+        return value
+
+    def get_many(self, keys, loader):
+        """Batched get(): loader(missing_keys) returns {key: value} for the
+        keys it could load, the result holds every key found."""
+        signature = self.signature()
+        found, missing = {}, []
+        with self._lock:
+            self._invalidate_if_changed(signature)
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+            self.misses += len(missing)
+        if not missing:
+            return found
+        loaded = loader(missing)
+        found.update(loaded)
+        self._store(signature, loaded)
+        return found
+
+    def _store(self, signature, values):
+        with self._lock:
+            # the library may have changed while loading, the values are then
+            # returned but not kept
+            if signature != self._signature:
+                return
+            self._entries.update(values)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def after_fork(self):
+        # the parent's watcher connection, and its lock if a thread held it,
+        # are left alone: the child starts over
+        self._lock = RLock()
+        self._entries = OrderedDict()
+        self._watcher = None
+        self._watcher_ino = None
+        self._signature = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._entries),
+                    'max_entries': self._max_entries}
@@ -0,0 +1,50 @@
+import os
+import sqlite3
+from urllib.parse import quote
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+
+def readonly_uri(db_path):
+    return 'file:%s?mode=ro' % quote(os.path.abspath(db_path))
+
+
+def connect_readonly(db_path, timeout=5.0):
+    return sqlite3.connect(readonly_uri(db_path), uri=True,
+            check_same_thread=False, timeout=timeout)
+
+
+def connect_writable(db_path, timeout=5.0):
+    """Connection for the few writes made without calibredb, transactions are
+    left to the caller."""
+    return sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+
+
+def create_library_engine(db_path, config):
+    """Engine for reading the calibre library.
+
+    Connections are opened read-only, and checked out of the pool for each
+    use: as many are opened as threads read at once, pool_size of them kept
+    across requests. Writes are left to calibredb, which readers must never
+    block."""
+    busy_timeout = int(config.get('LIBRARY_SQLITE_BUSY_TIMEOUT', 5000))
+    pragmas = [
+        'PRAGMA query_only = 1',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = %d' % int(config.get('LIBRARY_SQLITE_MMAP_SIZE', 0)),
+        'PRAGMA cache_size = %d' % int(config.get('LIBRARY_SQLITE_CACHE_SIZE', -2000)),
+        'PRAGMA busy_timeout = %d' % busy_timeout,
+    ]
+    engine = create_engine('sqlite://',
+            creator=lambda: connect_readonly(db_path, busy_timeout / 1000),
+            poolclass=QueuePool,
+            pool_size=int(config.get('LIBRARY_SQLITE_POOL_SIZE', 8)),
+            # never waits for a connection, nor closes one in use
+            max_overflow=-1)
+
+    @event.listens_for(engine, 'connect')
+    def _tune(dbapi_conn, _):
+        for pragma in pragmas:
+            dbapi_conn.execute(pragma)
+
+    return engine
@@ -1,63 +1,332 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Float, Index, Integer, String, create_engine, \
+        event, update, case, delete, func, or_, select, text
+from sqlalchemy.dialects.sqlite import insert
+from threading import Lock
 import os
+import sqlite3
+import time
+from .library_connection import readonly_uri
 
 Base = declarative_base()
 
+# a job counts as pending, for deduplication, while queued or running
+PENDING = ('QUEUED', 'RUNNING')
+FINISHED = ('COMPLETED', 'CANCELED')
+
 class JobLogs(Base):
+    """The job log, which is also the job queue: a job is queued by adding
+    its row, and claimed by a consumer for a lease it renews while running."""
     __tablename__ = 'joblogs'
     id = Column(Integer, primary_key=True)
     message = Column(String)
     status = Column(String)
+    name = Column(String)
+    kind = Column(String)
+    args = Column(String)
+    priority = Column(Integer, nullable=False, server_default=text('0'))
+    dedupe_key = Column(String)
+    lease_owner = Column(String)
+    lease_expires = Column(Float)
+    attempts = Column(Integer, nullable=False, server_default=text('0'))
+    created = Column(Float)
+    # bumped on each change of the row, in the order they were made
+    version = Column(Integer)
+
+    __table_args__ = (
+        Index('joblogs_queue_idx', 'status', 'priority', 'id'),
+        Index('joblogs_created_idx', 'created'),
+        Index('joblogs_version_idx', 'version'),
+        Index('joblogs_pending_idx', 'dedupe_key', unique=True,
+            sqlite_where=text("status IN ('QUEUED', 'RUNNING')")),
+    )
 
     def __repr__(self):
         return '[%i] %s - %s' % (self.id, self.status, self.message)
 
+class JobLogVersion(Base):
+    """The highest version of the rows deleted from the job log, which new
+    versions must stay above."""
+    __tablename__ = 'joblog_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
 class Actions:
     CLEAR = 0
     INSERT = 1
     UPDATE = 2
 
+_instances = {}
+_instances_lock = Lock()
+
+def joblogs_db(config):
+    """The JobLogsDB of the configured database, one per process."""
+    db_path = os.path.join(config['CALIBRE_WEBUI_DB_PATH'], 'calibrewebui_joblogs.db')
+    with _instances_lock:
+        if db_path not in _instances:
+            _instances[db_path] = JobLogsDB(config)
+        return _instances[db_path]
+
+def _after_fork():
+    # connections opened before a fork (uWSGI loads the app before forking
+    # its workers) must not be used by both sides
+    for instance in _instances.values():
+        instance._db_ng.dispose(close=False)
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def current_version():
+    # the rows holding the highest versions may have been deleted
+    return func.max(
+        func.coalesce(select(func.max(JobLogs.version)).scalar_subquery(), 0),
+        func.coalesce(select(JobLogVersion.version).scalar_subquery(), 0))
+
+def next_version():
+    # evaluated within the writing statement, hence in the order of the
+    # writes whichever process makes them
+    return select(current_version() + 1).scalar_subquery()
+
+def keep_version(con):
+    """Records the current version, to run before deleting rows in the same
+    transaction: versions only ever go up, or the clients following the
+    changes would miss those made after."""
+    stm = insert(JobLogVersion.__table__).values(id=1,
+            version=select(current_version()).scalar_subquery())
+    con.execute(stm.on_conflict_do_update(index_elements=['id'],
+        set_={'version': stm.excluded.version}))
+
+class JobLogWatcher:
+    """Tells whether the job log changed since the last call, for the cost of
+    a PRAGMA while it did not."""
+
+    def __init__(self, db_path):
+        self._con = sqlite3.connect(readonly_uri(db_path), uri=True,
+                check_same_thread=False)
+        self._data_version = None
+
+    def changed(self):
+        data_version = self._con.execute('PRAGMA data_version').fetchone()[0]
+        changed = data_version != self._data_version
+        self._data_version = data_version
+        return changed
+
+    def close(self):
+        self._con.close()
+
 class JobLogsDB:
+    """The job log. Use joblogs_db(), which keeps one per process."""
+
     def create_db(self):
         Base.metadata.create_all(self._db_ng)
 
+    def ensure_columns(self):
+        with self._db_ng.begin() as con:
+            # tables added since
+            Base.metadata.create_all(con)
+            columns = {row[1] for row in con.execute(text('PRAGMA table_info(joblogs)'))}
+            added = [column.name for column in JobLogs.__table__.columns
+                    if column.name not in columns]
+            for name in added:
+                column = JobLogs.__table__.c[name]
+                con.execute(text('ALTER TABLE joblogs ADD COLUMN %s %s%s' % (column.name,
+                    column.type.compile(self._db_ng.dialect),
+                    ' NOT NULL DEFAULT 0' if column.server_default is not None else '')))
+            # rows from before these columns would be left out of pruning by
+            # age and of the changes feed: they count as made now, in id order
+            if 'created' in added:
+                con.execute(update(JobLogs).values(created=time.time()))
+            if 'version' in added:
+                con.execute(update(JobLogs).values(version=JobLogs.id))
+            # pending duplicates, from before the unique index, would fail
+            # it: the oldest of each is kept
+            pending = JobLogs.status.in_(PENDING)
+            kept = select(func.min(JobLogs.id)).where(pending,
+                    JobLogs.dedupe_key.isnot(None)).group_by(JobLogs.dedupe_key)
+            con.execute(update(JobLogs).where(pending, JobLogs.dedupe_key.isnot(None),
+                JobLogs.id.notin_(kept)).values(status='CANCELED', version=next_version()))
+            # create_all skips the indexes of a table that exists
+            for index in JobLogs.__table__.indexes:
+                index.create(con, checkfirst=True)
+
     def __init__(self, config):
         db_path = os.path.join(config['CALIBRE_WEBUI_DB_PATH'],
                 'calibrewebui_joblogs.db')
-        self._db_ng = create_engine('sqlite:///%s' % db_path)
-        if not os.path.isfile(db_path):
+        exists = os.path.isfile(db_path)
+        self._db_path = db_path
+        self._db_ng = create_engine('sqlite:///%s' % db_path,
+                connect_args={'timeout': 30})
+
+        @event.listens_for(self._db_ng, 'connect')
+        def _tune(dbapi_conn, _):
+            # readers (every open page polls the job log) and the consumer's
+            # writes do not block each other in WAL mode
+            dbapi_conn.execute('PRAGMA journal_mode = WAL')
+            dbapi_conn.execute('PRAGMA synchronous = NORMAL')
+
+        if exists:
+            self.ensure_columns()
+        else:
             self.create_db()
-        self._session_maker = sessionmaker(bind=self._db_ng)
-
-    def clear_joblogs(self):
-        session = self._session_maker()
-        results = session.query(JobLogs).all()
-        for result in results:
-            session.delete(result)
-        session.commit()
-        session.close()
-
-    def list_joblogs(self):
-        session = self._session_maker()
-        results = session.query(JobLogs).all()
-        session.close()
-        return [{'message': i.message, 'status': i.status} for i in results]
+
+    def clear_joblogs(self, finished_only=False):
+        stm = delete(JobLogs)
+        if finished_only:
+            stm = stm.where(JobLogs.status.in_(FINISHED))
+        with self._db_ng.begin() as con:
+            keep_version(con)
+            con.execute(stm)
+
+    def list_joblogs(self, limit=None, before=None):
+        """The job log, oldest first. limit keeps the most recent entries,
+        before (an id) those preceding an entry, to page back from there."""
+        stm = select(JobLogs.id, JobLogs.message, JobLogs.status).order_by(JobLogs.id.desc())
+        if before is not None:
+            stm = stm.where(JobLogs.id < before)
+        if limit is not None:
+            stm = stm.limit(limit)
+        with self._db_ng.connect() as con:
+            rows = con.execute(stm).all()
+        return [{'id': i.id, 'message': i.message, 'status': i.status}
+                for i in reversed(rows)]
+
+    def joblog_changes(self, since, limit=500):
+        """Entries changed since version `since`, in the order they were."""
+        with self._db_ng.connect() as con:
+            rows = con.execute(select(JobLogs.id, JobLogs.message, JobLogs.status,
+                JobLogs.version).where(JobLogs.version > since)
+                .order_by(JobLogs.version).limit(limit)).all()
+        return [{'id': i.id, 'message': i.message, 'status': i.status,
+            'version': i.version} for i in rows]
+
+    def joblog_version(self):
+        with self._db_ng.connect() as con:
+            return con.execute(select(current_version())).scalar()
+
+    def watcher(self):
+        return JobLogWatcher(self._db_path)
+
+    def count_joblogs(self):
+        """{status: number of jobs}"""
+        with self._db_ng.connect() as con:
+            return dict(con.execute(select(JobLogs.status, func.count())
+                .group_by(JobLogs.status)).all())
+
+    def prune_joblogs(self, max_age, max_rows):
+        """Drops the finished jobs older than max_age seconds, and the
+        oldest finished jobs beyond max_rows."""
+        finished = JobLogs.status.in_(FINISHED)
+        with self._db_ng.begin() as con:
+            keep_version(con)
+            con.execute(delete(JobLogs).where(finished,
+                JobLogs.created < time.time() - max_age))
+            newest = select(JobLogs.id).where(finished).order_by(JobLogs.id.desc())\
+                    .limit(1).offset(max_rows).scalar_subquery()
+            con.execute(delete(JobLogs).where(finished, JobLogs.id <= newest))
 
     def push_joblog(self, message, status):
-        session = self._session_maker()
-        joblog = JobLogs(message=message, status=status)
-        session.add(joblog)
-        session.commit()
-        jobid = joblog.id
-        session.close()
-        return jobid
+        with self._db_ng.begin() as con:
+            return con.execute(JobLogs.__table__.insert().values(message=message,
+                status=status, created=time.time(), version=next_version()))\
+                .inserted_primary_key[0]
 
     def update_joblog(self, id, message, status):
-        session = self._session_maker()
-        joblog = session.query(JobLogs).filter(JobLogs.id == id).first()
-        joblog.message = message
-        joblog.status = status
-        session.commit()
-        session.close()
+        self._update(id, None, message=message, status=status)
+
+    def update_joblog_message(self, id, message):
+        self._update(id, None, message=message)
+
+    def cancel_joblog(self, id):
+        """Cancels a queued job, asks a running one to stop (CANCELING).
+        Returns the row of a job canceled before it started, True for a
+        running one, None when the job is already over."""
+        with self._db_ng.begin() as con:
+            joblog = con.execute(update(JobLogs)
+                    .where(JobLogs.id == id, JobLogs.status.in_(PENDING))
+                    .values(status=case((JobLogs.status == 'QUEUED', 'CANCELED'),
+                        else_='CANCELING'), version=next_version())
+                    .returning(JobLogs.status, JobLogs.kind, JobLogs.args)).first()
+        if joblog is None:
+            return None
+        return joblog if joblog.status == 'CANCELED' else True
+
+    def joblog_status(self, id):
+        with self._db_ng.connect() as con:
+            return con.execute(select(JobLogs.status).where(JobLogs.id == id)).scalar()
+
+    def _update(self, id, statuses, **values):
+        stm = update(JobLogs).where(JobLogs.id == id).values(version=next_version(),
+                **values)
+        if statuses:
+            stm = stm.where(JobLogs.status.in_(statuses))
+        with self._db_ng.begin() as con:
+            return con.execute(stm).rowcount > 0
+
+    # queue
+
+    def enqueue(self, kind, name, args, priority, dedupe_key):
+        """Queues a job, unless one with the same dedupe_key is pending.
+        Returns the id of the queued or pending job."""
+        with self._db_ng.begin() as con:
+            res = con.execute(JobLogs.__table__.insert().prefix_with('OR IGNORE')
+                    .values(message=name, status='QUEUED', name=name, kind=kind,
+                        args=args, priority=priority, dedupe_key=dedupe_key,
+                        created=time.time(), version=next_version()))
+            if res.rowcount:
+                return res.inserted_primary_key[0]
+            return con.execute(select(JobLogs.id).where(JobLogs.dedupe_key == dedupe_key,
+                JobLogs.status.in_(PENDING))).scalar()
+
+    def claim(self, owner, kinds, lease_expires):
+        """Starts the most urgent queued job of one of the kinds, held by
+        owner until lease_expires. None when there is none."""
+        if not kinds:
+            return None
+        next_job = select(JobLogs.id).where(JobLogs.status == 'QUEUED',
+                JobLogs.kind.in_(kinds)).order_by(JobLogs.priority, JobLogs.id)\
+                .limit(1).scalar_subquery()
+        # looked for first so that an empty queue costs no write lock
+        with self._db_ng.connect() as con:
+            if con.execute(select(next_job)).scalar() is None:
+                return None
+        with self._db_ng.begin() as con:
+            return con.execute(update(JobLogs).where(JobLogs.id == next_job,
+                JobLogs.status == 'QUEUED')
+                .values(status='RUNNING', lease_owner=owner, lease_expires=lease_expires,
+                    attempts=JobLogs.attempts + 1, version=next_version())
+                .returning(JobLogs.id, JobLogs.kind, JobLogs.name, JobLogs.args,
+                    JobLogs.priority)).first()
+
+    def renew_leases(self, owner, lease_expires):
+        with self._db_ng.begin() as con:
+            con.execute(update(JobLogs).where(JobLogs.lease_owner == owner,
+                JobLogs.status.in_(('RUNNING', 'CANCELING')))
+                .values(lease_expires=lease_expires))
+
+    def finish(self, id, owner, message, status):
+        """Ends a job, unless its lease was lost to another consumer."""
+        with self._db_ng.begin() as con:
+            return con.execute(update(JobLogs).where(JobLogs.id == id,
+                JobLogs.lease_owner == owner,
+                JobLogs.status.in_(('RUNNING', 'CANCELING')))
+                .values(message=message, status=status, lease_owner=None,
+                    lease_expires=None, version=next_version())).rowcount > 0
+
+    def expired_leases(self, now):
+        with self._db_ng.connect() as con:
+            return con.execute(select(JobLogs.id, JobLogs.kind, JobLogs.name,
+                JobLogs.args, JobLogs.status, JobLogs.attempts, JobLogs.lease_expires)
+                .where(JobLogs.status.in_(('RUNNING', 'CANCELING')),
+                    # no lease at all: left running by a version without
+                    # the queue
+                    or_(JobLogs.lease_expires < now, JobLogs.lease_expires.is_(None))))\
+                .all()
+
+    def recover(self, job, message, status):
+        """Takes back a job whose lease expired, as QUEUED to run it again or
+        as CANCELED. False when its consumer renewed the lease meanwhile."""
+        with self._db_ng.begin() as con:
+            return con.execute(update(JobLogs).where(JobLogs.id == job.id,
+                JobLogs.status == job.status,
+                JobLogs.lease_expires.is_not_distinct_from(job.lease_expires))
+                .values(message=message, status=status, lease_owner=None,
+                    lease_expires=None, version=next_version())).rowcount > 0
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import Column, Integer, String, create_engine, delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+Base = declarative_base()
+
+# signature of a book without a file to count the pages of
+NO_FILE = ('', 0, 0)
+
+
+class PageScanFile(Base):
+    """The file a book's page count was last taken from."""
+    __tablename__ = 'page_scan_files'
+    book = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+
+
+class PageScanDB:
+    def __init__(self, config):
+        db_path = os.path.join(config['CALIBRE_WEBUI_DB_PATH'], 'calibrewebui.db')
+        self._db_ng = create_engine('sqlite:///%s' % db_path)
+        Base.metadata.create_all(self._db_ng)
+        self._session_maker = sessionmaker(bind=self._db_ng)
+
+    def signatures(self):
+        with self._session_maker() as session:
+            return {row.book: (row.path, row.size, row.mtime_ns)
+                    for row in session.execute(select(PageScanFile.__table__))}
+
+    def save(self, signatures):
+        if not signatures:
+            return
+        stm = insert(PageScanFile.__table__)
+        stm = stm.on_conflict_do_update(index_elements=['book'],
+                set_={'path': stm.excluded.path, 'size': stm.excluded.size,
+                    'mtime_ns': stm.excluded.mtime_ns})
+        with self._session_maker() as session:
+            session.execute(stm, [{'book': book, 'path': path, 'size': size,
+                'mtime_ns': mtime_ns} for book, (path, size, mtime_ns)
+                in signatures.items()])
+            session.commit()
+
+    def forget(self, book_ids):
+        book_ids = list(book_ids)
+        with self._session_maker() as session:
+            for i in range(0, len(book_ids), 500):
+                session.execute(delete(PageScanFile)
+                        .where(PageScanFile.book.in_(book_ids[i:i + 500])))
+            session.commit()
+
+
+def file_signature(path):
+    if not path:
+        return NO_FILE
+    try:
+        st = os.stat(path)
+    except OSError:
+        return NO_FILE
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def python_executable():
+    # under uWSGI sys.executable is the uwsgi binary
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    for prefix in (sys.exec_prefix, sys.base_exec_prefix):
+        for name in ('python%d.%d' % sys.version_info[:2], 'python3'):
+            path = os.path.join(prefix, 'bin', name)
+            if os.access(path, os.X_OK):
+                return path
+    return sys.executable
+
+
+def scan_pool(workers):
+    # the processes running jobs have threads of their own, whose locks a
+    # forked child could inherit held: children are forked from a fork
+    # server instead, a python process of its own with the modules they use
+    # (extract_page_count, thumbnails) imported once
+    context = multiprocessing.get_context('forkserver')
+    context.set_executable(python_executable())
+    context.set_forkserver_preload(['calibre_wrapper.page_count',
+        'calibre_wrapper.thumbnails'])
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+            mp_context=context)
@@ -0,0 +1,189 @@
+import json
+import os
+import socket
+import time
+import uuid
+from threading import Condition, Thread
+from . import logdb
+
+# lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_FOLLOW_UP = 5
+PRIORITY_BACKGROUND = 10
+
+# seconds between two looks at the job log for a cancel request
+CANCEL_POLL_INTERVAL = 1
+# seconds between two prunings of the job log
+PRUNE_INTERVAL = 3600
+
+
+class JobCanceled(Exception):
+    pass
+
+
+class Job:
+    """A job claimed by this process.
+
+    The function runs with the job as first argument, to report progress
+    and check for cancellation: cancel requests go through the job log, so
+    that whichever process serves them reaches the job."""
+
+    def __init__(self, log, row):
+        self.id = row.id
+        self.kind = row.kind
+        self.name = row.name
+        self.priority = row.priority
+        self.args = json.loads(row.args)
+        self._log = log
+        self._canceled = False
+        self._cancel_checked = 0
+
+    @property
+    def canceled(self):
+        if not self._canceled and \
+                time.monotonic() - self._cancel_checked >= CANCEL_POLL_INTERVAL:
+            self._cancel_checked = time.monotonic()
+            self._canceled = self._log.joblog_status(self.id) \
+                    in ('CANCELING', 'CANCELED', None)
+        return self._canceled
+
+    def check_canceled(self):
+        if self.canceled:
+            raise JobCanceled()
+
+    def progress(self, message):
+        self._log.update_joblog_message(self.id, message)
+
+
+class JobScheduler:
+    """Job queue kept in the job log, shared by every process of the app.
+
+    Any process submits jobs; consumers (run(), or start() for a thread of
+    the current process) claim them most urgent first, and run at most
+    `workers` at once, at most limits[kind] of a kind. A consumer holds a
+    lease on the jobs it runs and renews it while they run: the jobs of a
+    consumer that died are queued again once their lease expired, up to
+    max_attempts runs. Consumers also drop the finished jobs older than
+    retention_days, or beyond the retention_rows most recent."""
+
+    def __init__(self, config, workers, limits, lease=60, poll_interval=1,
+            max_attempts=3, retention_days=30, retention_rows=1000):
+        self._log = logdb.joblogs_db(config)
+        self._workers = max(1, workers)
+        self._limits = limits
+        self._lease = lease
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._retention = (retention_days * 86400, retention_rows)
+        self._handlers = {}
+        self._running = {}
+        self._condition = Condition()
+        self._owner = None
+
+    def register(self, kind, fn, cleanup=None):
+        """fn(job, *args) runs the jobs of a kind, and may return their final
+        message. cleanup(*args) runs once a job is over, whether it ran or
+        not, to drop what the job was left."""
+        self._handlers[kind] = (fn, cleanup)
+
+    def submit(self, kind, name, *args, priority=PRIORITY_INTERACTIVE,
+            dedupe_key=None):
+        """Queues a job and returns its id. A job with the same kind and
+        arguments (or the same dedupe_key) already pending is not queued
+        again, its id is returned instead."""
+        args = json.dumps(args)
+        return self._log.enqueue(kind, name, args, priority,
+                dedupe_key or '%s:%s' % (kind, args))
+
+    def cancel(self, job_id):
+        canceled = self._log.cancel_joblog(job_id)
+        if canceled is not None and canceled is not True:
+            # canceled before it started, nobody will run it
+            self._cleanup(canceled.kind, canceled.args)
+        return canceled is not None
+
+    def start(self):
+        thread = Thread(target=self.run, daemon=True, name='job-consumer')
+        thread.start()
+        return thread
+
+    def run(self):
+        """Consumes jobs, forever."""
+        self._owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                uuid.uuid4().hex[:8])
+        Thread(target=self._heartbeat, daemon=True, name='job-heartbeat').start()
+        last_recovery = last_prune = 0
+        while True:
+            if time.monotonic() - last_recovery >= self._lease / 2:
+                last_recovery = time.monotonic()
+                self._recover()
+            if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                try:
+                    self._log.prune_joblogs(*self._retention)
+                except Exception as e:
+                    print('job log pruning failed: %s' % e, flush=True)
+            with self._condition:
+                while sum(self._running.values()) >= self._workers:
+                    self._condition.wait()
+                kinds = [kind for kind in self._handlers
+                        if self._running.get(kind, 0) < self._limits.get(kind, self._workers)]
+            row = self._log.claim(self._owner, kinds, time.time() + self._lease)
+            if row is None:
+                with self._condition:
+                    # woken early when one of our jobs ends
+                    self._condition.wait(self._poll_interval)
+                continue
+            job = Job(self._log, row)
+            with self._condition:
+                self._running[job.kind] = self._running.get(job.kind, 0) + 1
+            Thread(target=self._run_job, args=(job,), daemon=True,
+                    name='job-%d' % job.id).start()
+
+    def _run_job(self, job):
+        fn, _ = self._handlers[job.kind]
+        try:
+            try:
+                message, status = fn(job, *job.args) or job.name, 'COMPLETED'
+            except JobCanceled:
+                message, status = '%s (canceled)' % job.name, 'CANCELED'
+            except Exception as e:
+                print('job %s failed: %s' % (job.name, e), flush=True)
+                message, status = '%s (failed)' % job.name, 'CANCELED'
+            # unless the job was taken back from us meanwhile
+            if self._log.finish(job.id, self._owner, message, status):
+                self._cleanup(job.kind, json.dumps(job.args))
+        finally:
+            with self._condition:
+                self._running[job.kind] -= 1
+                self._condition.notify_all()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self._lease / 3)
+            try:
+                self._log.renew_leases(self._owner, time.time() + self._lease)
+            except Exception as e:
+                print('job lease renewal failed: %s' % e, flush=True)
+
+    def _recover(self):
+        try:
+            expired = self._log.expired_leases(time.time())
+        except Exception as e:
+            print('job recovery failed: %s' % e, flush=True)
+            return
+        for job in expired:
+            if job.status == 'RUNNING' and job.kind in self._handlers \
+                    and job.attempts < self._max_attempts:
+                if self._log.recover(job, job.name, 'QUEUED'):
+                    print('job %s lost its consumer, queued again' % job.name, flush=True)
+            elif self._log.recover(job, '%s (consumer lost)' % job.name, 'CANCELED'):
+                self._cleanup(job.kind, job.args)
+
+    def _cleanup(self, kind, args):
+        _, cleanup = self._handlers.get(kind, (None, None))
+        if cleanup:
+            try:
+                cleanup(*json.loads(args))
+            except Exception as e:
+                print('job cleanup failed: %s' % e, flush=True)
@@ -0,0 +1,218 @@
+import html
+import json
+import os
+import re
+from collections import Counter
+from threading import RLock
+from sqlalchemy import create_engine, event, text, Integer, Float
+from sqlalchemy.sql import table, column
+
+SEARCH_SCHEMA = 'webui_search'
+SEARCH_COLUMNS = ('title', 'authors', 'series', 'tags', 'comments')
+# bm25 weights, in SEARCH_COLUMNS order: a hit in the title outranks one
+# buried in the comments
+SEARCH_WEIGHTS = (10.0, 6.0, 4.0, 2.0, 1.0)
+SYNC_CHUNK_SIZE = 500
+FACETS = ('authors', 'tags', 'series', 'formats')
+
+# per book facet values and their book counts, kept along the full-text index
+BOOK_FACETS = table('books_facets', column('book'), column('facet'),
+        column('name'), schema=SEARCH_SCHEMA)
+FACET_COUNTS = table('facet_counts', column('facet'), column('name'),
+        column('count'), schema=SEARCH_SCHEMA)
+
+RE_HTML_TAG = re.compile(r'<[^>]+>')
+RE_QUERY_TERM = re.compile(r'\w+')
+
+
+def search_db_path(config):
+    return os.path.join(config['CALIBRE_WEBUI_DB_PATH'],
+            'calibrewebui_search.db')
+
+
+def fts_query(search, columns=None):
+    terms = RE_QUERY_TERM.findall(search or '')
+    if not terms:
+        return None
+    # every term must match, as a prefix so results show up while typing
+    query = ' '.join('"%s"*' % term for term in terms)
+    if columns:
+        query = '{%s} : (%s)' % (' '.join(columns), query)
+    return query
+
+
+def comment_text(comment):
+    if not comment:
+        return ''
+    return html.unescape(RE_HTML_TAG.sub(' ', comment))
+
+
+class SearchIndex:
+    """Accent folded FTS5 index of the library, kept next to the webui db,
+    along with the books of each author, tag, series and format (FACETS) and
+    their book counts.
+
+    The calibre engine attaches it as SEARCH_SCHEMA so searches can join it
+    against the library tables; this class only maintains its content."""
+
+    def create_db(self):
+        with self._db_ng.begin() as con:
+            had_facets = con.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'books_facets'").first()
+            con.exec_driver_sql(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(%s, '
+                'tokenize="unicode61 remove_diacritics 2")'
+                % ', '.join(SEARCH_COLUMNS))
+            # a rank function set in the table config survives the subquery
+            # being flattened into the library query, bm25() does not
+            con.exec_driver_sql(
+                "INSERT INTO books_fts (books_fts, rank) VALUES ('rank', 'bm25(%s)')"
+                % ', '.join('%.1f' % weight for weight in SEARCH_WEIGHTS))
+            con.exec_driver_sql(
+                'CREATE TABLE IF NOT EXISTS books_fts_state ('
+                'book INTEGER PRIMARY KEY, last_modified TEXT)')
+            con.exec_driver_sql(
+                'CREATE TABLE IF NOT EXISTS books_facets ('
+                'book INTEGER, facet TEXT, name TEXT COLLATE NOCASE, '
+                'PRIMARY KEY (book, facet, name)) WITHOUT ROWID')
+            con.exec_driver_sql(
+                'CREATE TABLE IF NOT EXISTS facet_counts ('
+                'facet TEXT, name TEXT COLLATE NOCASE, count INTEGER, '
+                'PRIMARY KEY (facet, name)) WITHOUT ROWID')
+            if not had_facets:
+                # indexes built before facets were kept must be redone whole
+                con.exec_driver_sql('DELETE FROM books_fts')
+                con.exec_driver_sql('DELETE FROM books_fts_state')
+
+    def __init__(self, config):
+        self._db_path = search_db_path(config)
+        self._db_ng = create_engine('sqlite:///%s' % self._db_path,
+                connect_args={'timeout': 60})
+
+        @event.listens_for(self._db_ng, 'connect')
+        def _connect(dbapi_conn, _):
+            # let sqlalchemy drive transactions so they can start IMMEDIATE:
+            # several uwsgi workers may try to sync the index at once
+            dbapi_conn.isolation_level = None
+            dbapi_conn.execute('PRAGMA journal_mode=WAL')
+
+        @event.listens_for(self._db_ng, 'begin')
+        def _begin(con):
+            con.exec_driver_sql('BEGIN IMMEDIATE')
+
+        self._lock = RLock()
+        self._signature = None
+        try:
+            self.create_db()
+            self.available = True
+        except Exception as e:
+            print('full-text search unavailable: %s' % e, flush=True)
+            self.available = False
+
+    def after_fork(self):
+        # a sync running when the process forked holds the lock, and its
+        # thread is not in the child to release it
+        self._lock = RLock()
+        self._db_ng.dispose(close=False)
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    def is_fresh(self, signature):
+        return signature == self._signature
+
+    def sync(self, signature, list_stamps, load_documents, load_facets):
+        """Bring the index up to date with the library.
+
+        list_stamps() returns {book_id: last_modified} for the whole library,
+        load_documents(ids) the SEARCH_COLUMNS of the given books, prefixed by
+        their id, and load_facets(ids) their (book_id, facet, name) triples.
+        signature identifies the library state being indexed."""
+        if not self.available or self.is_fresh(signature):
+            return
+        with self._lock:
+            if self.is_fresh(signature):
+                return
+            stamps = list_stamps()
+            with self._db_ng.begin() as con:
+                indexed = dict(con.exec_driver_sql(
+                    'SELECT book, last_modified FROM books_fts_state').all())
+                removed = [book_id for book_id in indexed
+                        if book_id not in stamps]
+                stale = [book_id for book_id, stamp in stamps.items()
+                        if indexed.get(book_id) != stamp]
+                self._remove(con, removed + stale)
+                for i in range(0, len(stale), SYNC_CHUNK_SIZE):
+                    chunk = stale[i:i + SYNC_CHUNK_SIZE]
+                    self._insert(con, load_documents(chunk), stamps)
+                    self._insert_facets(con, load_facets(chunk))
+            if removed or stale:
+                print('search index: %d updated, %d removed'
+                        % (len(stale), len(removed)), flush=True)
+            self._signature = signature
+
+    @staticmethod
+    def _remove(con, book_ids):
+        params = [(book_id,) for book_id in book_ids]
+        if not params:
+            return
+        con.exec_driver_sql('DELETE FROM books_fts WHERE rowid = ?', params)
+        con.exec_driver_sql('DELETE FROM books_fts_state WHERE book = ?', params)
+        for i in range(0, len(book_ids), SYNC_CHUNK_SIZE):
+            chunk = json.dumps(book_ids[i:i + SYNC_CHUNK_SIZE])
+            counts = con.exec_driver_sql(
+                'SELECT count(*), facet, name FROM books_facets '
+                'WHERE book IN (SELECT value FROM json_each(?)) '
+                'GROUP BY facet, name', (chunk,)).all()
+            if counts:
+                con.exec_driver_sql('UPDATE facet_counts SET count = count - ? '
+                        'WHERE facet = ? AND name = ?', [tuple(row) for row in counts])
+            con.exec_driver_sql('DELETE FROM books_facets '
+                    'WHERE book IN (SELECT value FROM json_each(?))', (chunk,))
+        con.exec_driver_sql('DELETE FROM facet_counts WHERE count <= 0')
+
+    @staticmethod
+    def _insert(con, documents, stamps):
+        rows = [tuple(doc) for doc in documents]
+        if not rows:
+            return
+        con.exec_driver_sql(
+            'INSERT INTO books_fts (rowid, %s) VALUES (?, %s)'
+            % (', '.join(SEARCH_COLUMNS), ', '.join('?' * len(SEARCH_COLUMNS))),
+            rows)
+        con.exec_driver_sql(
+            'INSERT INTO books_fts_state (book, last_modified) VALUES (?, ?)',
+            [(row[0], stamps[row[0]]) for row in rows])
+
+    @staticmethod
+    def _insert_facets(con, facets):
+        rows = list(dict.fromkeys(tuple(row) for row in facets))
+        if not rows:
+            return
+        con.exec_driver_sql(
+            'INSERT OR IGNORE INTO books_facets (book, facet, name) VALUES (?, ?, ?)',
+            rows)
+        counts = Counter((facet, name) for _, facet, name in rows)
+        con.exec_driver_sql(
+            'INSERT INTO facet_counts (facet, name, count) VALUES (?, ?, ?) '
+            'ON CONFLICT (facet, name) DO UPDATE SET count = count + excluded.count',
+            [(facet, name, count) for (facet, name), count in counts.items()])
+
+    def rebuild(self):
+        with self._lock:
+            with self._db_ng.begin() as con:
+                con.exec_driver_sql('DELETE FROM books_fts')
+                con.exec_driver_sql('DELETE FROM books_fts_state')
+                con.exec_driver_sql('DELETE FROM books_facets')
+                con.exec_driver_sql('DELETE FROM facet_counts')
+            self._signature = None
+
+    @staticmethod
+    def match():
+        """Subquery of the (book, rank) pairs matching the fts_query() bound
+        as :fts_query, meant to run on a connection that attached the index."""
+        return text('SELECT rowid AS book, rank FROM %s.books_fts '
+                'WHERE books_fts MATCH :fts_query' % SEARCH_SCHEMA)\
+            .columns(book=Integer, rank=Float)\
+            .subquery('fts')
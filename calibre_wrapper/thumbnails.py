@@ -0,0 +1,94 @@
+import os
+import uuid
+from PIL import Image, features
+
+# heights in pixels
+THUMBNAIL_SIZES = {'feed': 200, 'grid': 400, 'detail': 800}
+DEFAULT_SIZE = 'grid'
+# file extension: (Pillow format, mime type), preferred first
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+
+class ThumbnailCache:
+    """Thumbnails of the covers, at a few sizes and formats, kept in a tree of
+    their own: <directory>/<book_id // 1000>/<book_id>/<size>_<cover mtime>.<ext>
+
+    A thumbnail is named after the mtime of the cover it was made from, so
+    that a cover changed by calibre gets new ones, those of the previous
+    cover being dropped then."""
+
+    def __init__(self, directory, sizes=None, quality=80):
+        self._dir = directory
+        self.sizes = {name: int(height) for name, height
+                in (sizes or THUMBNAIL_SIZES).items()}
+        self._quality = quality
+        self.formats = [ext for ext, (fmt, _) in THUMBNAIL_FORMATS.items()
+                if fmt != 'WEBP' or features.check('webp')]
+
+    def _book_dir(self, book_id):
+        return os.path.join(self._dir, str(book_id // 1000), str(book_id))
+
+    def path(self, book_id, size, ext, cover_mtime_ns):
+        return os.path.join(self._book_dir(book_id),
+                '%s_%d.%s' % (size, cover_mtime_ns, ext))
+
+    def get(self, book_id, cover_path, size, ext):
+        """Path of the thumbnail of a cover, made if missing. Raises OSError
+        when the cover cannot be read."""
+        path = self.path(book_id, size, ext, os.stat(cover_path).st_mtime_ns)
+        if not os.path.exists(path):
+            self.make(book_id, cover_path, [(size, ext)])
+        return path
+
+    def missing(self, book_id, cover_path):
+        """(size, ext) of the thumbnails of a cover not made yet."""
+        cover_mtime_ns = os.stat(cover_path).st_mtime_ns
+        return [(size, ext) for size in self.sizes for ext in self.formats
+                if not os.path.exists(self.path(book_id, size, ext, cover_mtime_ns))]
+
+    def make(self, book_id, cover_path, wanted):
+        """Makes the [(size, ext), ...] thumbnails of a cover, decoding it
+        once for all."""
+        if not wanted:
+            return
+        cover_mtime_ns = os.stat(cover_path).st_mtime_ns
+        os.makedirs(self._book_dir(book_id), exist_ok=True)
+        with Image.open(cover_path) as img:
+            largest = max(self.sizes[size] for size, _ in wanted)
+            if img.height > largest:
+                # JPEG covers are decoded straight at a fraction of their
+                # size (1/2, 1/4 or 1/8), no smaller than asked
+                img.draft('RGB', (max(1, round(img.width * largest / img.height)), largest))
+            img = img.convert('RGB')
+            for size, ext in wanted:
+                path = self.path(book_id, size, ext, cover_mtime_ns)
+                tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex[:8])
+                try:
+                    _scaled(img, self.sizes[size]).save(tmp_path,
+                            THUMBNAIL_FORMATS[ext][0], quality=self._quality)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        self._drop_stale(book_id, cover_mtime_ns)
+
+    def _drop_stale(self, book_id, cover_mtime_ns):
+        # made from a previous cover
+        for entry in os.scandir(self._book_dir(book_id)):
+            if entry.name.endswith('.tmp'):
+                continue
+            if entry.name.rsplit('.', 1)[0].rsplit('_', 1)[-1] != str(cover_mtime_ns):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+def _scaled(img, height):
+    if img.height <= height:
+        return img
+    return img.resize((max(1, round(img.width * height / img.height)), height),
+            Image.LANCZOS)
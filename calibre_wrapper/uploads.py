@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from .inbox import PROCESSING_DIR, FAILED_DIR
+
+Base = declarative_base()
+
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_DIR_PREFIX = 'upload_'
+
+
+class FormatHash(Base):
+    """sha256 of a library file, as of its size and mtime."""
+    __tablename__ = 'format_hashes'
+    path = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+    sha256 = Column(String, nullable=False)
+
+
+class FormatHashDB:
+    def __init__(self, config):
+        db_path = os.path.join(config['CALIBRE_WEBUI_DB_PATH'], 'calibrewebui.db')
+        self._db_ng = create_engine('sqlite:///%s' % db_path)
+        Base.metadata.create_all(self._db_ng)
+        self._session_maker = sessionmaker(bind=self._db_ng)
+
+    def digest(self, path):
+        """sha256 of a file, only read again when it changed since last
+        asked. None when it cannot be read."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._session_maker() as session:
+            row = session.execute(select(FormatHash.__table__)
+                    .where(FormatHash.path == path)).first()
+            if row is not None and (row.size, row.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                return row.sha256
+            try:
+                digest = file_digest(path)
+            except OSError:
+                return None
+            stm = insert(FormatHash.__table__).values(path=path, size=st.st_size,
+                    mtime_ns=st.st_mtime_ns, sha256=digest)
+            session.execute(stm.on_conflict_do_update(index_elements=['path'],
+                set_={'size': stm.excluded.size, 'mtime_ns': stm.excluded.mtime_ns,
+                    'sha256': stm.excluded.sha256}))
+            session.commit()
+        return digest
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_upload(stream, tmp_dir, filename):
+    """Writes an uploaded file to a directory of its own under tmp_dir, so
+    that uploads of the same name never meet, hashing it on the way.
+    Returns (path, size, sha256)."""
+    upload_dir = tempfile.mkdtemp(prefix=UPLOAD_DIR_PREFIX, dir=tmp_dir)
+    path = os.path.join(upload_dir, filename)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except Exception:
+        remove_upload(path)
+        raise
+    return path, size, digest.hexdigest()
+
+
+def keep_failed_upload(path):
+    """Moves a file from the inbox that could not be imported to its
+    FAILED_DIR, rather than have it removed with the uploads. Returns its
+    new path, None for an upload through the web, which is left to
+    remove_upload()."""
+    batch_dir = os.path.dirname(path)
+    if os.path.basename(os.path.dirname(batch_dir)) != PROCESSING_DIR:
+        return None
+    failed_dir = os.path.join(os.path.dirname(os.path.dirname(batch_dir)), FAILED_DIR)
+    os.makedirs(failed_dir, exist_ok=True)
+    dest = os.path.join(failed_dir, os.path.basename(path))
+    if os.path.exists(dest):
+        name, ext = os.path.splitext(os.path.basename(path))
+        dest = os.path.join(failed_dir, '%s_%s%s' % (name, os.path.basename(batch_dir)[:8], ext))
+    os.rename(path, dest)
+    return dest
+
+
+def remove_upload(path):
+    if os.path.exists(path):
+        os.remove(path)
+    directory = os.path.dirname(path)
+    # uploads and inbox batches come in a directory of their own
+    if os.path.basename(directory).startswith(UPLOAD_DIR_PREFIX) or \
+            os.path.basename(os.path.dirname(directory)) == PROCESSING_DIR:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass